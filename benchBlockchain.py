@@ -0,0 +1,381 @@
+""" Rough benchmarks for the blockchain APIs.  Run with: python3 benchBlockchain.py [numBlocks [numUtxos]] """
+import sys
+import threading
+import time
+import tracemalloc
+
+from blockchain import *
+
+EASY_TARGET = 2**256 - 1   # every hash meets this target, so mining is a single hash
+
+
+SECRET = b"preimage secret"
+SECRET_HASH = hashlib.sha256(SECRET).digest()
+
+
+def MakeChainBlocks(genesisHash, numBlocks, txsPerBlock=2, scripted=False):
+    """ Build (but do not connect) a straight chain of numBlocks blocks on top of genesisHash.
+        Every block mints txsPerBlock - 1 outputs of a unique amount and spends the previous block's ones.
+        If scripted, the outputs need a sha256 preimage to be spent, so spending runs a real constraint. """
+    if scripted:
+        constraint = lambda x: hashlib.sha256(x[0]).digest() == SECRET_HASH
+        satisfier = [SECRET]
+    else:
+        constraint = lambda x: True
+        satisfier = []
+
+    blocks = []
+    parent = genesisHash
+    prevMint = None
+    for i in range(numBlocks):
+        mint = Transaction(None, [Output(constraint, i + 1) for j in range(max(1, txsPerBlock - 1))])
+        txs = [mint]
+        if prevMint != None:
+            for j in range(len(prevMint.outputs)):
+                txs.append(Transaction([Input(prevMint.getHash(), j, list(satisfier))], [Output(constraint, i)]))
+        b = Block()
+        b.setPriorBlockHash(parent)
+        b.setContents(txs)
+        b.mine(EASY_TARGET)
+        blocks.append(b)
+        parent = b.getHash()
+        prevMint = mint
+    return blocks
+
+
+def Timed(fn):
+    start = time.perf_counter()
+    ret = fn()
+    return ret, time.perf_counter() - start
+
+
+def BenchExtendMany(numBlocks):
+    chain = Blockchain(EASY_TARGET, 10**9)
+    blocks = MakeChainBlocks(chain.getTip().getHash(), numBlocks)
+
+    def loop():
+        for b in blocks:
+            chain.extend(b)
+    _, loopTime = Timed(loop)
+
+    chain = Blockchain(EASY_TARGET, 10**9)
+    results, manyTime = Timed(lambda: chain.extendMany(iter(blocks)))
+    assert(all(results))
+
+    print("extend loop: %d blocks in %.3fs (%.0f blocks/s)" % (numBlocks, loopTime, numBlocks / loopTime))
+    print("extendMany:  %d blocks in %.3fs (%.0f blocks/s)" % (numBlocks, manyTime, numBlocks / manyTime))
+
+
+def BenchRejection(numBlocks, numJunk=10000):
+    """ Time to reject junk blocks (bad proof of work, intra-block double spend) on top of a chain of numBlocks """
+    chain = Blockchain(EASY_TARGET, 10**9)
+    blocks = MakeChainBlocks(chain.getTip().getHash(), numBlocks)
+    chain.extendMany(blocks)
+    tipHash = chain.getTip().getHash()
+    spend = Transaction([Input(blocks[-1].getContents()[0].getHash(), 0, [])], [Output(None, 1)])
+
+    junk = []
+    for i in range(numJunk):
+        b = Block()
+        b.setPriorBlockHash(tipHash)
+        b.nonce = i
+        if i % 2:
+            b.setContents([Transaction(None, [Output(None, 1)])])
+            b.setTarget(1)  # hash will not meet this
+        else:
+            b.setContents([Transaction(None, [Output(None, 1)]), spend, spend])
+            b.setTarget(EASY_TARGET)
+        junk.append(b)
+
+    def reject():
+        for b in junk:
+            assert(not chain.extend(b))
+    _, rejectTime = Timed(reject)
+    print("junk rejection: %.1f us/block on a %d block chain %s" % (rejectTime / numJunk * 1e6, numBlocks, chain.getRejectionCounts()))
+
+    # the same junk sent again is dropped by the known-invalid cache, as are resent valid blocks
+    _, resendTime = Timed(reject)
+    _, knownTime = Timed(lambda: [chain.extend(b) for b in blocks])
+    print("resent junk: %.1f us/block, resent valid: %.1f us/block %s"
+          % (resendTime / numJunk * 1e6, knownTime / numBlocks * 1e6, chain.getDuplicateCounts()))
+
+
+def BenchFilters(numBlocks, txsPerBlock=20):
+    """ Size of the block filters and time to scan a chain for a small wallet """
+    chain = Blockchain(EASY_TARGET, 10**9)
+    blocks = MakeChainBlocks(chain.getTip().getHash(), numBlocks, txsPerBlock)
+    chain.extendMany(blocks)
+
+    _, buildTime = Timed(lambda: [chain.getBlockFilter(b.getHash()) for b in blocks])
+    filterBytes = sum(len(chain.getBlockFilter(b.getHash()).encoded) for b in blocks)
+    wallet = [(blocks[i].getContents()[0].getHash(), 0) for i in range(0, numBlocks, max(1, numBlocks // 5))]
+    matches, scanTime = Timed(lambda: chain.matchFilters(wallet))
+    print("filters: %d blocks x %d txs, built in %.3fs, %d bytes total; wallet scan %.3fs, %d matching blocks"
+          % (numBlocks, txsPerBlock, buildTime, filterBytes, scanTime, len(matches)))
+
+
+def BenchConcurrentReads(numBlocks, numReaders=4):
+    """ Snapshot read throughput of reader threads while a writer extends the chain block by block """
+    chain = Blockchain(EASY_TARGET, 10**9)
+    blocks = MakeChainBlocks(chain.getTip().getHash(), numBlocks)
+    done = threading.Event()
+    reads = [0] * numReaders
+
+    def reader(n):
+        count = 0
+        while not done.is_set():
+            snap = chain.getSnapshot()
+            snap.getBlockAtHeight(count % (snap.height + 1))
+            snap.getTip()
+            count += 1
+        reads[n] = count
+
+    def writer():
+        for b in blocks:
+            chain.extend(b)
+        done.set()
+
+    threads = [threading.Thread(target=reader, args=(n,)) for n in range(numReaders)]
+    for t in threads:
+        t.start()
+    _, writeTime = Timed(writer)
+    for t in threads:
+        t.join()
+    print("concurrent reads: %d readers did %.0f snapshot reads/s while %d blocks were extended in %.3fs"
+          % (numReaders, sum(reads) / writeTime, numBlocks, writeTime))
+
+
+def BenchAssumeValid(numBlocks, txsPerBlock=50):
+    """ Initial sync time of a scripted chain with and without assume-valid """
+    genesisHash = Blockchain(EASY_TARGET, 10**9).getTip().getHash()
+    blocks = MakeChainBlocks(genesisHash, numBlocks, txsPerBlock, scripted=True)
+
+    chain = Blockchain(EASY_TARGET, 10**9)
+    results, fullTime = Timed(lambda: chain.extendMany(blocks))
+    assert(all(results))
+
+    chain = Blockchain(EASY_TARGET, 10**9, assumeValid=blocks[-1].getHash())
+    chain.loadAssumeValidHeaders(blocks)
+    results, assumeTime = Timed(lambda: chain.extendMany(blocks))
+    assert(all(results) and chain.assumedValidCount == numBlocks)
+    print("assume-valid sync: %d blocks x %d txs, full %.3fs, assume-valid %.3fs (%.1fx)"
+          % (numBlocks, txsPerBlock, fullTime, assumeTime, fullTime / assumeTime))
+
+
+def BenchLazyContents(numBlocks, txsPerBlock=20):
+    """ Sync and full history scan with block contents held in a small LRU content cache """
+    cache = ContentCache(MemoryContentStore(), maxBytes=256 * 1024)
+    chain = Blockchain(EASY_TARGET, 10**9, contentCache=cache)
+    blocks = MakeChainBlocks(chain.getTip().getHash(), numBlocks, txsPerBlock)
+    results, syncTime = Timed(lambda: chain.extendMany(blocks))
+    assert(all(results))
+
+    def scan():
+        return sum(len(b.getContents()) for b in blocks)
+    numTxs, scanTime = Timed(scan)
+    print("lazy contents: sync %.3fs, scan of %d txs %.3fs, compressed store %d bytes, cache %s"
+          % (syncTime, numTxs, scanTime, sum(len(v) for v in cache.store.blobs.values()), cache.getStats()))
+
+
+def BenchUtxoTable(numEntries):
+    """ Memory per entry and lookup rate of a UtxoTable against a dict of Outputs with numEntries entries.
+        The request's target size is 10M entries: python3 benchBlockchain.py 500 10000000 (needs several GB for the dict). """
+    rng = random.Random(1)
+    keys = [(rng.getrandbits(256), rng.randrange(4)) for i in range(numEntries)]
+    probes = [keys[rng.randrange(numEntries)] for i in range(min(numEntries, 200000))]
+
+    def fill(container):
+        for i, key in enumerate(keys):
+            container[key] = Output(lambda x: x[0] == "alice", i)
+        return container
+
+    for name, make in [("dict", dict), ("UtxoTable", UtxoTable)]:
+        # tracemalloc slows allocation down a lot, so time a second fill without it
+        tracemalloc.start()
+        container = fill(make())
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del container
+        container, fillTime = Timed(lambda: fill(make()))
+
+        def lookups():
+            for key in probes:
+                container[key].amount
+        _, lookupTime = Timed(lookups)
+        print("%-9s %d entries: %.0f bytes/entry, filled in %.2fs, %.0f lookups/s"
+              % (name, numEntries, size / numEntries, fillTime, len(probes) / lookupTime))
+        del container
+
+
+def BenchHashing(numBlocks, numLeaves=2000, rounds=20):
+    """ Merkle root and extend speed, which are dominated by hashing """
+    txs = [Transaction(None, [Output(None, i)]) for i in range(numLeaves)]
+    tree = HashableMerkleTree(txs)
+    _, merkleTime = Timed(lambda: [tree.calcMerkleRoot() for i in range(rounds)])
+
+    chain = Blockchain(EASY_TARGET, 10**9)
+    blocks = MakeChainBlocks(chain.getTip().getHash(), numBlocks, 20)
+
+    def loop():
+        for b in blocks:
+            chain.extend(b)
+    _, extendTime = Timed(loop)
+    print("hashing: calcMerkleRoot of %d txs %.2fms, extend %d blocks x 20 txs %.3fs"
+          % (numLeaves, merkleTime / rounds * 1000, numBlocks, extendTime))
+
+
+class CountHashing:
+    """ Count the sha256 computations of transactions, block headers and merkle roots while active.
+        With memoize=False the hash memos are bypassed, to show how many there were without them. """
+    def __init__(self, memoize=True):
+        self.memoize = memoize
+        self.counts = {"transaction": 0, "block": 0, "merkleRoot": 0}
+
+    def __enter__(self):
+        counts = self.counts
+        self.saved = [(cls, name, cls.__dict__[name]) for cls, name in
+                      [(Transaction, "computeDigest"), (Block, "computeDigest"), (HashableMerkleTree, "calcMerkleRoot"),
+                       (Transaction, "getHash"), (Transaction, "hashDigest"), (Block, "memoizedHash"), (BlockContents, "calcMerkleRoot")]]
+        txDigest, blockDigest, merkleRoot = [fn for cls, name, fn in self.saved[:3]]
+        Transaction.computeDigest = lambda tx: counts.__setitem__("transaction", counts["transaction"] + 1) or txDigest(tx)
+        Block.computeDigest = lambda b: counts.__setitem__("block", counts["block"] + 1) or blockDigest(b)
+        HashableMerkleTree.calcMerkleRoot = lambda t: counts.__setitem__("merkleRoot", counts["merkleRoot"] + 1) or merkleRoot(t)
+        if not self.memoize:
+            Transaction.getHash = lambda tx: int.from_bytes(tx.computeDigest(), "big")
+            Transaction.hashDigest = lambda tx: tx.computeDigest()
+            Block.memoizedHash = lambda b: (None, b.computeDigest(), int.from_bytes(b.computeDigest(), "big"))
+            BlockContents.calcMerkleRoot = lambda c: HashableMerkleTree(c.data if hasTransactions(c.data) else None).calcMerkleRoot()
+        return self
+
+    def __exit__(self, *exc):
+        for cls, name, fn in self.saved:
+            setattr(cls, name, fn)
+
+
+def BenchHashCounts(numBlocks, txsPerBlock=20):
+    """ sha256 computations per extend, with and without the hash memos.
+        The block hash memos are dropped before extending, as for blocks received from a peer. """
+    for memoize in (False, True):
+        with CountHashing(memoize) as counter:
+            chain = Blockchain(EASY_TARGET, 10**9)
+            blocks = MakeChainBlocks(chain.getTip().getHash(), numBlocks, txsPerBlock)
+            for b in blocks:
+                b.unfreeze()
+                b.hashMemo = None
+            for key in counter.counts:
+                counter.counts[key] = 0
+            _, extendTime = Timed(lambda: [chain.extend(b) for b in blocks])
+        print("hash calls per extend %-10s %s (%d blocks x %d txs in %.3fs)"
+              % ("memoized:" if memoize else "unmemoized:", {k: round(v / numBlocks, 1) for k, v in counter.counts.items()},
+                 numBlocks, txsPerBlock, extendTime))
+
+
+def BenchHeaders(numBlocks, txsPerBlock=20):
+    """ Header ingest rate and memory per block of a headers-only chain, against a full chain """
+    genesisHash = Blockchain(EASY_TARGET, 10**9).getTip().getHash()
+    blocks = MakeChainBlocks(genesisHash, numBlocks, txsPerBlock)
+    headers = [b.getHeader() for b in blocks]
+
+    for name, make, feed in [("full", lambda: Blockchain(EASY_TARGET, 10**9), blocks),
+                             ("headers-only", lambda: Blockchain(EASY_TARGET, 10**9, headersOnly=True), headers)]:
+        chain = make()
+        results, ingestTime = Timed(lambda: chain.extendMany(feed))
+        assert(all(results))
+        # memory held per block by the chain itself, blocks fed to it are measured apart from it
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        fresh = [b.getHeader() for b in blocks] if feed is headers else MakeChainBlocks(genesisHash, numBlocks, txsPerBlock)
+        chain = make()
+        chain.extendMany(fresh)
+        del fresh
+        size = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        print("%-12s ingest: %d blocks in %.3fs (%.0f blocks/s), %.0f bytes/block"
+              % (name, numBlocks, ingestTime, numBlocks / ingestTime, size / numBlocks))
+        del chain
+
+
+def BenchChainStats(numBlocks, txsPerBlock=20, rounds=1000):
+    """ getChainStats against counting the same totals with a scan of the active chain """
+    chain = Blockchain(EASY_TARGET, 10**9)
+    chain.extendMany(MakeChainBlocks(chain.getTip().getHash(), numBlocks, txsPerBlock))
+
+    def scan():
+        outputs, spent = 0, 0
+        for block, txn in chain.iterTransactions():
+            outputs += len(txn.outputs)
+            spent += len(txn.inputs)
+        return outputs - spent
+    utxos, scanTime = Timed(scan)
+    stats, statsTime = Timed(lambda: [chain.getChainStats() for i in range(rounds)])
+    assert(stats[-1]["utxos"] == utxos)
+    print("chain stats: getChainStats %.1f us, full scan %.2fms (%d blocks x %d txs)"
+          % (statsTime / rounds * 1e6, scanTime * 1000, numBlocks, txsPerBlock))
+
+    # the set hash is kept up to date as blocks connect; only the final division waits for the first read
+    _, firstTime = Timed(chain.getUtxoCommitment)
+    _, againTime = Timed(lambda: [chain.getUtxoCommitment() for i in range(rounds)])
+    print("utxo commitment: first read %.2fms, then %.1f us" % (firstTime * 1000, againTime / rounds * 1e6))
+
+
+def BenchFinality(numBlocks, txsPerBlock=20, finalityDepth=6):
+    """ Memory of a chain with a competing block at every height, with and without stale fork collection """
+    genesisHash = Blockchain(EASY_TARGET, 10**9).getTip().getHash()
+
+    def makeBlocks():
+        blocks = MakeChainBlocks(genesisHash, numBlocks, txsPerBlock)
+        batch = []
+        for block in blocks:
+            stale = Block()
+            stale.time = 4
+            stale.setPriorBlockHash(block.getPriorBlockHash())
+            stale.setContents([Transaction(None, [Output(None, 1) for i in range(txsPerBlock)])])
+            stale.mine(EASY_TARGET)
+            batch += [block, stale]
+        return batch
+
+    for depth in (None, finalityDepth):
+        # only the chain holds on to the blocks once they are extended
+        tracemalloc.start()
+        chain = Blockchain(EASY_TARGET, 10**9, finalityDepth=depth)
+        for b in makeBlocks():
+            chain.extend(b)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("finality depth %-4s %d blocks kept, %.1f MB traced, %s"
+              % (depth, len(chain.blockHashMapping), size / 1e6, chain.getGcStats()))
+        del chain
+
+
+def BenchScripts(rounds=100000):
+    """ Evaluation throughput of Script constraints against the equivalent lambdas """
+    cases = [
+        ("equality", lambda x: x[0] == "alice", Script("ARG 0 PUSH alice EQUAL"), ["alice"]),
+        ("add", lambda x: x[0] + x[1] == 100, Script("ARG 0 ARG 1 ADD PUSH 100 EQUAL"), [40, 60]),
+        ("preimage", lambda x: hashlib.sha256(x[0]).digest() == SECRET_HASH, Script("ARG 0 SHA256 PUSH 0x%s EQUAL" % SECRET_HASH.hex()), [SECRET]),
+    ]
+    for name, fn, script, satisfier in cases:
+        assert(fn(satisfier) and script(satisfier))
+        _, lambdaTime = Timed(lambda: [fn(satisfier) for i in range(rounds)])
+        _, scriptTime = Timed(lambda: [script(satisfier) for i in range(rounds)])
+        print("script %-8s lambda %.2fM evals/s, script %.2fM evals/s, %d bytes serialized"
+              % (name, rounds / lambdaTime / 1e6, rounds / scriptTime / 1e6, len(script.serialize())))
+
+
+def Bench(numBlocks=500, numUtxos=200000):
+    BenchExtendMany(numBlocks)
+    BenchRejection(numBlocks)
+    BenchFilters(numBlocks)
+    BenchConcurrentReads(numBlocks)
+    BenchAssumeValid(numBlocks)
+    BenchLazyContents(numBlocks)
+    BenchUtxoTable(numUtxos)
+    BenchHashing(numBlocks)
+    BenchHashCounts(numBlocks)
+    BenchHeaders(numBlocks)
+    BenchChainStats(numBlocks)
+    BenchFinality(numBlocks)
+    BenchScripts()
+
+if __name__ == "__main__":
+    Bench(*[int(a) for a in sys.argv[1:3]])
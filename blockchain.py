@@ -36,12 +36,288 @@ import pdb
 import copy
 import json
 import pickle
+import asyncio
+import os
+import queue
 import random
-from collections import defaultdict
+import shlex
+import sys
+import threading
+import zlib
+from array import array
+from collections import defaultdict, OrderedDict
+from collections.abc import Mapping, MutableMapping
+from types import FunctionType
 
 # pip3 install dill
 import dill
 
+def hasTransactions(contents):
+    """ Return True if block contents hold a list of transactions.
+        A block whose contents were never set (or set to None) carries no transactions. """
+    return contents is not None and type(contents) != HashableMerkleTree
+
+
+MAX_TARGET = 2**256 - 1   # the easiest possible target: any sha256 hash meets it
+
+# Blockchain.extend rejects blocks at the first of these stages that fails, in this order
+VALIDATION_STAGES = ("orphan", "pow", "structure", "amounts", "scripts")
+
+# what a block adds to the active chain totals (see Block.calcStats and ChainSnapshot.getChainStats)
+BLOCK_STATS = ("transactions", "outputs", "spent", "minted", "burned")
+NO_BLOCK_STATS = (0, 0, 0, 0, 0)
+
+
+def compactHistory(values):
+    """ Return values as an array("q"), or as a list if any of them does not fit in 64 bits (amounts are unbounded) """
+    values = list(values)
+    if all(-2**63 <= value < 2**63 for value in values):
+        return array("q", values)
+    return values
+
+
+class Hash32(bytes):
+    """ A sha256 digest kept as its 32 raw bytes.
+        Being fixed length and big endian, byte order is numeric order, so a Hash32 compares directly
+        against a target encoded the same way (see Hash32.fromInt).  int(h) gives the integer form
+        that the public APIs (getHash and friends) return; it is only computed when asked for.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def fromInt(cls, value):
+        return cls(value.to_bytes(32, "big"))
+
+    def __int__(self):
+        return int.from_bytes(self, "big")
+
+    def meetsTarget(self, target):
+        """ Return True if this hash, as a number, is <= target (an int) """
+        return target >= MAX_TARGET or self <= target.to_bytes(32, "big")
+
+
+ZERO_HASH = Hash32(bytes(32))
+
+
+class Script:
+    """ A constraint script in a small stack language, usable anywhere a constraint lambda is
+        (Output(Script("ARG 0 PUSH alice EQUAL"), 10)), but serializable and with bounded cost.
+
+        The source is a list of opcodes, the program runs against the satisfier list and spending is
+        allowed if it ends with True on top of the stack:
+            ARG n      push satisfier[n]
+            PUSH v     push a constant: an integer, 0x... bytes, or a string ("quote" strings with spaces)
+            TRUE/FALSE push True/False
+            DUP        duplicate the top item
+            EQUAL      pop two items, push whether they are equal
+            ADD        pop two integers, push their sum
+            SHA256     pop bytes, push their sha256 digest
+            VERIFY     pop an item, fail unless it is True
+        For example "ARG 0 ARG 1 ADD PUSH 100 EQUAL" is lambda x: x[0] + x[1] == 100, and
+        "ARG 0 SHA256 PUSH 0x<digest> EQUAL" checks a hash preimage.
+
+        A script is compiled once to a compact byte code (see serialize) and from that to a python function;
+        both are cached by byte code (the MAX_CACHED most recently used), so equal scripts share one compiled form.  There are no jumps, so a
+        script runs one step per opcode: scripts longer than maxSteps are refused (return False), and any
+        error (bad types, missing argument, stack underflow) also returns False.
+    """
+    OPCODES = ["ARG", "PUSH", "TRUE", "FALSE", "DUP", "EQUAL", "ADD", "SHA256", "VERIFY"]
+    ARG, PUSH, TRUE, FALSE, DUP, EQUAL, ADD, SHA256, VERIFY = range(len(OPCODES))
+    INT, BYTES, STR = range(3)   # PUSH constant types
+    MAX_STEPS = 256
+    MAX_SIZE = 10000
+    MAX_CACHED = 4096
+
+    programCache = OrderedDict()   # byte code -> (program, function), least recently used first
+    cacheLock = threading.Lock()
+
+    def __init__(self, source=None, code=None):
+        """ Build a script from its source text, or from serialized byte code """
+        if code is None:
+            code = self.assemble(source)
+        self.code = bytes(code)
+        self.program, self.function = self.compile(self.code)
+
+    @classmethod
+    def assemble(cls, source):
+        """ Translate source text to byte code """
+        code = bytearray()
+        tokens = shlex.split(source)
+        i = 0
+        while i < len(tokens):
+            op = cls.OPCODES.index(tokens[i].upper())
+            code.append(op)
+            if op == cls.ARG:
+                i += 1
+                code.append(int(tokens[i]))
+            elif op == cls.PUSH:
+                i += 1
+                code += cls.encodeConstant(cls.parseConstant(tokens[i]))
+            i += 1
+        return bytes(code)
+
+    @staticmethod
+    def parseConstant(token):
+        if token.startswith("0x"):
+            return bytes.fromhex(token[2:])
+        try:
+            return int(token)
+        except ValueError:
+            return token
+
+    @classmethod
+    def encodeConstant(cls, value):
+        if type(value) == int:
+            data = value.to_bytes((value.bit_length() + 8) // 8, "big", signed=True)
+            kind = cls.INT
+        elif type(value) == str:
+            data = value.encode()
+            kind = cls.STR
+        else:
+            data = bytes(value)
+            kind = cls.BYTES
+        return bytes([kind]) + len(data).to_bytes(2, "big") + data
+
+    @classmethod
+    def compile(cls, code):
+        """ Decode byte code to a tuple of (opcode, argument) pairs, and translate that to a python function.
+            Both are cached by byte code.  Raise ValueError if the byte code is malformed or truncated. """
+        with cls.cacheLock:
+            cached = cls.programCache.get(code)
+            if cached != None:
+                cls.programCache.move_to_end(code)
+                return cached
+        if len(code) > cls.MAX_SIZE:
+            raise ValueError("script too large")
+
+        program = []
+        pos = 0
+        while pos < len(code):
+            op = code[pos]
+            pos += 1
+            arg = None
+            if op == cls.ARG:
+                if pos >= len(code):
+                    raise ValueError("truncated ARG")
+                arg = code[pos]
+                pos += 1
+            elif op == cls.PUSH:
+                if pos + 3 > len(code):
+                    raise ValueError("truncated PUSH")
+                kind = code[pos]
+                size = int.from_bytes(code[pos+1:pos+3], "big")
+                if pos + 3 + size > len(code):
+                    raise ValueError("truncated PUSH")
+                data = code[pos+3:pos+3+size]
+                pos += 3 + size
+                if kind == cls.INT:
+                    arg = int.from_bytes(data, "big", signed=True)
+                elif kind == cls.STR:
+                    arg = data.decode()
+                elif kind == cls.BYTES:
+                    arg = bytes(data)
+                else:
+                    raise ValueError("unknown constant type %d" % kind)
+            elif op >= len(cls.OPCODES):
+                raise ValueError("unknown opcode %d" % op)
+            program.append((op, arg))
+
+        program = tuple(program)
+        compiled = (program, cls.translate(program))
+        with cls.cacheLock:
+            compiled = cls.programCache.setdefault(code, compiled)
+            while len(cls.programCache) > cls.MAX_CACHED:
+                cls.programCache.popitem(last=False)
+        return compiled
+
+    @classmethod
+    def translate(cls, program):
+        """ Turn a program into a straight line python function of the satisfier, so running a script
+            costs about as much as the equivalent lambda.  There are no jumps, so the stack can be
+            resolved at translation time: every opcode becomes one assignment to a new local, and
+            constants are passed in by name, never pasted into the source. """
+        lines = []
+        stack = []
+        names = {"scriptAdd": scriptAdd, "scriptSha256": scriptSha256}
+        for i, (op, arg) in enumerate(program):
+            var = "v%d" % i
+            if op == cls.ARG:
+                lines.append("%s = x[%d]" % (var, arg))
+            elif op == cls.PUSH:
+                names["c%d" % i] = arg
+                lines.append("%s = c%d" % (var, i))
+            elif op in (cls.TRUE, cls.FALSE):
+                lines.append("%s = %s" % (var, op == cls.TRUE))
+            elif not stack:   # stack underflow: the script can never succeed
+                return lambda x: False
+            elif op == cls.DUP:
+                lines.append("%s = %s" % (var, stack[-1]))
+            elif op == cls.SHA256:
+                lines.append("%s = scriptSha256(%s)" % (var, stack.pop()))
+            elif op == cls.VERIFY:
+                lines.append("if %s is not True: return False" % stack.pop())
+                continue
+            elif len(stack) < 2:
+                return lambda x: False
+            else:
+                b, a = stack.pop(), stack.pop()
+                if op == cls.EQUAL:
+                    lines.append("%s = %s == %s" % (var, a, b))
+                else:
+                    lines.append("%s = scriptAdd(%s, %s)" % (var, a, b))
+            stack.append(var)
+        lines.append("return %s is True" % stack[-1] if stack else "return False")
+
+        source = "def run(x):\n    try:\n" + "".join("        %s\n" % line for line in lines)
+        source += "    except Exception:\n        return False\n"
+        exec(source, names)
+        return names["run"]
+
+    def serialize(self):
+        """ Return the byte code of this script """
+        return self.code
+
+    @classmethod
+    def deserialize(cls, code):
+        return cls(code=code)
+
+    def run(self, satisfier, maxSteps=None):
+        """ Evaluate the script against satisfier, return True if spending is allowed """
+        if maxSteps is None:
+            maxSteps = self.MAX_STEPS
+        if len(self.program) > maxSteps:
+            return False
+        return self.function(satisfier)
+
+    def __call__(self, satisfier):
+        if len(self.program) > self.MAX_STEPS:
+            return False
+        return self.function(satisfier)
+
+    def __eq__(self, other):
+        return type(other) == Script and other.code == self.code
+
+    def __hash__(self):
+        return hash(self.code)
+
+    def __repr__(self):
+        return "Script(code=%r)" % self.code
+
+
+def scriptAdd(a, b):
+    """ Script ADD: integers only """
+    if type(a) != int or type(b) != int:
+        raise TypeError("ADD needs integers")
+    return a + b
+
+
+def scriptSha256(data):
+    """ Script SHA256: bytes only """
+    if type(data) != bytes:
+        raise TypeError("SHA256 needs bytes")
+    return hashlib.sha256(data).digest()
+
+
 class Output:
     """ This models a transaction output """
     def __init__(self, constraint = None, amount = 0):
@@ -58,6 +334,8 @@ class Output:
 
             If the constraint is None, then allow spending without constraint
 
+            The constraint can also be a Script, which (unlike a lambda) is serializable and part of the transaction hash
+
             amount is the quantity of tokens associated with this output """
         if constraint == None:
             self.constraint = lambda x: True
@@ -104,23 +382,52 @@ class Transaction:
 
         self.data = data   # to store arbitrary data 
 
+        # (digest, integer hash), memoized once the transaction is frozen
+        self.frozenHash = None
+
+    def freeze(self):
+        """ Memoize this transaction's hash.  Block.setContents freezes its transactions: from then on
+            their inputs and outputs must not be changed. """
+        if self.frozenHash == None:
+            digest = self.computeDigest()
+            self.frozenHash = (digest, int.from_bytes(digest, "big"))
+        return self
+
     def getHash(self):
         """Return this transaction's probabilistically unique identifier as an integer"""
         # should return object's sha256 hash as a big endian integer
+        if self.frozenHash != None:
+            return self.frozenHash[1]
+        return int.from_bytes(self.computeDigest(), "big")
 
-        # considering txHash, txIdx of Inputs and amount from Outputs for creating the transaction hash
-        msg = hashlib.sha256();
+    def getHashBytes(self):
+        """ Return this transaction's hash as a Hash32 """
+        return Hash32(self.hashDigest())
 
-        if len(self.inputs) > 0:
-            for input in self.inputs:
-                msg.update(input.txHash.to_bytes(32,"big"))
-                msg.update(input.txIdx.to_bytes(32,"big"))
-        
-        if len(self.outputs) > 0:
-            for output in self.outputs:
-                msg.update(output.amount.to_bytes(32,"big"))
-        
-        return int.from_bytes(msg.digest(),"big")
+    def hashDigest(self):
+        if self.frozenHash != None:
+            return self.frozenHash[0]
+        return self.computeDigest()
+
+    def computeDigest(self):
+        # considering txHash, txIdx of Inputs and amount from Outputs for creating the transaction hash
+        # the counts, the script marker and the script length keep the encoding unambiguous, so different
+        # transactions can't be serialized to the same bytes
+        msg = hashlib.sha256()
+        msg.update(len(self.inputs).to_bytes(4,"big"))
+        for input in self.inputs:
+            msg.update(input.txHash.to_bytes(32,"big"))
+            msg.update(input.txIdx.to_bytes(32,"big"))
+        msg.update(len(self.outputs).to_bytes(4,"big"))
+        for output in self.outputs:
+            msg.update(output.amount.to_bytes(32,"big"))
+            # scripts (unlike lambdas) can be serialized, so they are part of the transaction hash
+            if type(output.constraint) == Script:
+                msg.update(b"\x01" + len(output.constraint.code).to_bytes(4,"big"))
+                msg.update(output.constraint.code)
+            else:
+                msg.update(b"\x00")
+        return msg.digest()
 
     def getInputs(self):
         """ return a list of all inputs that are being spent """
@@ -152,37 +459,287 @@ class Transaction:
             unspentOutputDict is a dictionary of items of the following format: { (txHash, offset) : Output }
             Return True if this transaction is valid, or False.
         """
-        
-        # two conditions: 
-        # 1. Income >= Expenses 
-        # 2. All the inputs should be part of unspentOutputDict
+        return self.validateAmounts(unspentOutputDict) and self.validateScripts(unspentOutputDict)
 
+    def validateAmounts(self, unspentOutputDict):
+        """ Check that every input refers to an unspent output and that income >= expenses.
+            Constraint scripts are not run (see validateScripts). """
         totalIncome, totalExpenses = 0, 0
         
         for output in self.outputs:
             totalExpenses += output.amount 
 
-        # print("UTXO : ")
-        # for key, val in unspentOutputDict.items():
-        #     print(key, val)
-        # print()
-
-        for i in range(len(self.inputs)):
-            input = self.inputs[i]
-            txHash = input.txHash
-            txIdx = input.txIdx
-            if (txHash, txIdx) not in unspentOutputDict: # bogus input hash
-                # print("Bogus input hash")
+        for input in self.inputs:
+            unspentOutput = unspentOutputDict.get((input.txHash, input.txIdx))
+            if unspentOutput is None: # bogus input hash
                 return False 
-            unspentOutput = unspentOutputDict[(txHash, txIdx)]
-            if input.satisfier==[] or unspentOutput.constraint(input.satisfier): # if constraint is satisfied alone spend the output
-                totalIncome += unspentOutput.amount
-            else:
-                return False
+            totalIncome += unspentOutput.amount
         
         # Expenses should always be less than or equal to income
         return totalIncome >= totalExpenses
 
+    def validateScripts(self, unspentOutputDict):
+        """ Run the constraint script of every output this transaction spends.
+            Assumes validateAmounts passed, so every input is in unspentOutputDict. """
+        for input in self.inputs:
+            if input.satisfier == []: # no satisfier, the output is spent without running its constraint
+                continue
+            try:
+                if unspentOutputDict[(input.txHash, input.txIdx)].constraint(input.satisfier) is not True:
+                    return False
+            except Exception:   # a constraint that throws does not allow spending
+                return False
+        return True
+
+
+class UtxoTable(MutableMapping):
+    """ A compact { (txHash, offset) : Output } map for large unspent output sets.
+
+        Instead of a dict of tuple keys and Output objects, entries live in flat arrays:
+        the outpoints as fixed 36 byte keys (32 byte hash + 4 byte index) in one bytearray,
+        searched by open addressing with linear probing; the amounts in a parallel int64 array
+        (amounts outside its range are marked there with BIG_AMOUNT and kept in a side dict);
+        and the constraints as an index into a table that stores each distinct constraint once
+        (lambdas created from the same expression with no captured variables count as one).
+        Lookups build a fresh Output from those parts, so it can be passed anywhere
+        Transaction.validate expects its dictionary.
+    """
+    KEY_SIZE = 36
+    EMPTY, USED, DELETED = 0, 1, 2
+    MAX_LOAD = 0.6
+    BIG_AMOUNT = -2**63
+
+    def __init__(self, items=None, capacity=16):
+        self.allocate(capacity)
+        self.bigAmounts = {}        # key bytes -> amount, for amounts that don't fit the int64 array
+        self.constraints = []       # constraint table, None marks a free slot
+        self.constraintRefs = []    # number of entries using each constraint
+        self.constraintIds = {}     # dedup key -> constraint table index
+        self.freeConstraints = []
+        if items != None:
+            self.update(items)
+
+    def allocate(self, capacity):
+        self.capacity = capacity
+        self.keys = bytearray(capacity * self.KEY_SIZE)
+        self.state = bytearray(capacity)
+        self.amounts = array("q", bytes(8 * capacity))
+        self.constraintIndex = array("i", bytes(4 * capacity))
+        self.count = 0
+        self.deleted = 0
+
+    @staticmethod
+    def keyBytes(key):
+        txHash = key[0]
+        if type(txHash) == Hash32:   # already bytes, e.g. from getHashBytes
+            return txHash + key[1].to_bytes(4, "big")
+        return txHash.to_bytes(32, "big") + key[1].to_bytes(4, "big")
+
+    def findKey(self, key):
+        """ Return the slot holding key, or -1.  A key that can't be encoded (e.g. an index past 4 bytes, which
+            a spending input can name) can't have been stored, so it is simply not found. """
+        try:
+            keyBytes = self.keyBytes(key)
+        except OverflowError:
+            return -1
+        return self.find(keyBytes)[0]
+
+    def find(self, keyBytes):
+        """ Return (slot holding keyBytes or -1, first free slot to insert it at) """
+        size = self.KEY_SIZE
+        slot = hash(keyBytes) % self.capacity
+        insertAt = -1
+        while True:
+            state = self.state[slot]
+            if state == self.EMPTY:
+                return -1, (slot if insertAt < 0 else insertAt)
+            if state == self.USED:
+                if self.keys[slot * size:(slot + 1) * size] == keyBytes:
+                    return slot, slot
+            elif insertAt < 0:
+                insertAt = slot
+            slot += 1
+            if slot == self.capacity:
+                slot = 0
+
+    @staticmethod
+    def constraintKey(constraint):
+        """ Constraints that are the same code with no captured state behave the same, so share a table slot """
+        if type(constraint) == FunctionType and constraint.__closure__ is None:
+            return (constraint.__code__, id(constraint.__globals__), constraint.__defaults__)
+        if type(constraint) == Script:
+            return constraint.code
+        return id(constraint)
+
+    def addConstraint(self, constraint):
+        key = self.constraintKey(constraint)
+        index = self.constraintIds.get(key)
+        if index is None:
+            if self.freeConstraints:
+                index = self.freeConstraints.pop()
+                self.constraints[index] = constraint
+                self.constraintRefs[index] = 0
+            else:
+                index = len(self.constraints)
+                self.constraints.append(constraint)
+                self.constraintRefs.append(0)
+            self.constraintIds[key] = index
+        self.constraintRefs[index] += 1
+        return index
+
+    def releaseConstraint(self, index):
+        self.constraintRefs[index] -= 1
+        if self.constraintRefs[index] == 0:
+            del self.constraintIds[self.constraintKey(self.constraints[index])]
+            self.constraints[index] = None
+            self.freeConstraints.append(index)
+
+    def resize(self, capacity):
+        old = (self.capacity, self.keys, self.state, self.amounts, self.constraintIndex)
+        self.allocate(capacity)
+        oldCapacity, keys, state, amounts, constraintIndex = old
+        size = self.KEY_SIZE
+        for slot in range(oldCapacity):
+            if state[slot] == self.USED:
+                keyBytes = bytes(keys[slot * size:(slot + 1) * size])
+                found, newSlot = self.find(keyBytes)
+                self.store(newSlot, keyBytes, amounts[slot], constraintIndex[slot])
+                self.count += 1
+
+    def store(self, slot, keyBytes, amount, constraintIndex):
+        self.keys[slot * self.KEY_SIZE:(slot + 1) * self.KEY_SIZE] = keyBytes
+        self.state[slot] = self.USED
+        self.amounts[slot] = amount
+        self.constraintIndex[slot] = constraintIndex
+
+    def amountAt(self, slot):
+        amount = self.amounts[slot]
+        if amount == self.BIG_AMOUNT:
+            return self.bigAmounts[bytes(self.keys[slot * self.KEY_SIZE:(slot + 1) * self.KEY_SIZE])]
+        return amount
+
+    def __setitem__(self, key, output):
+        # encode everything before the table is touched, so a bad key or amount leaves it as it was
+        keyBytes = self.keyBytes(key)
+        amount = output.amount
+        if not self.BIG_AMOUNT < amount < 2**63:
+            amount = self.BIG_AMOUNT
+        slot, insertAt = self.find(keyBytes)
+        index = self.addConstraint(output.constraint)
+        if amount == self.BIG_AMOUNT:
+            self.bigAmounts[keyBytes] = output.amount
+        elif self.bigAmounts:
+            self.bigAmounts.pop(keyBytes, None)
+        if slot >= 0:
+            self.releaseConstraint(self.constraintIndex[slot])
+            self.store(slot, keyBytes, amount, index)
+            return
+        if self.state[insertAt] == self.DELETED:
+            self.deleted -= 1
+        self.store(insertAt, keyBytes, amount, index)
+        self.count += 1
+        if self.count + self.deleted > self.capacity * self.MAX_LOAD:
+            self.resize(self.capacity * 2 if self.count > self.capacity * self.MAX_LOAD / 2 else self.capacity)
+
+    def __getitem__(self, key):
+        slot = self.findKey(key)
+        if slot < 0:
+            raise KeyError(key)
+        return Output(self.constraints[self.constraintIndex[slot]], self.amountAt(slot))
+
+    def get(self, key, default=None):
+        slot = self.findKey(key)
+        if slot < 0:
+            return default
+        return Output(self.constraints[self.constraintIndex[slot]], self.amountAt(slot))
+
+    def __contains__(self, key):
+        return self.findKey(key) >= 0
+
+    def __delitem__(self, key):
+        slot = self.findKey(key)
+        if slot < 0:
+            raise KeyError(key)
+        self.releaseConstraint(self.constraintIndex[slot])
+        if self.amounts[slot] == self.BIG_AMOUNT:
+            del self.bigAmounts[bytes(self.keys[slot * self.KEY_SIZE:(slot + 1) * self.KEY_SIZE])]
+        self.state[slot] = self.DELETED
+        self.count -= 1
+        self.deleted += 1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        size = self.KEY_SIZE
+        for slot in range(self.capacity):
+            if self.state[slot] == self.USED:
+                keyBytes = self.keys[slot * size:(slot + 1) * size]
+                yield (int.from_bytes(keyBytes[:32], "big"), int.from_bytes(keyBytes[32:], "big"))
+
+    def memoryUsage(self):
+        """ Return the approximate number of bytes held by the tables """
+        return (sys.getsizeof(self.keys) + sys.getsizeof(self.state) + sys.getsizeof(self.amounts)
+                + sys.getsizeof(self.constraintIndex) + sys.getsizeof(self.constraints))
+
+
+class MuHash:
+    """ An order independent hash of a multiset of byte strings, for committing to the unspent output set.
+
+        Every item maps to a number modulo the prime 2**3072 - 1103717.  Adding an item multiplies it into
+        the numerator and removing one multiplies it into the denominator, so each is one multiplication
+        and the same set hashes the same whatever order it was built in.  digest() divides the two (the
+        one expensive step, done once and remembered) and hashes the result down to 32 bytes.
+        A MuHash is not changed once it is part of a chain's history: add, remove and combine are used
+        while building one, combined() makes a new one.
+    """
+    PRIME = 2**3072 - 1103717
+    BITS = 3072
+    MASK = 2**3072 - 1
+    OFFSET = 1103717   # 2**3072 mod PRIME
+
+    def __init__(self, numerator=1, denominator=1):
+        self.numerator = numerator
+        self.denominator = denominator
+        self.digestBytes = None
+
+    @classmethod
+    def mulMod(cls, a, b):
+        """ a * b mod PRIME, reducing with 2**3072 = OFFSET (mod PRIME) instead of a division """
+        x = a * b
+        x = (x & cls.MASK) + (x >> cls.BITS) * cls.OFFSET
+        x = (x & cls.MASK) + (x >> cls.BITS) * cls.OFFSET
+        return x - cls.PRIME if x >= cls.PRIME else x
+
+    @classmethod
+    def element(cls, item):
+        """ Map a byte string to a number modulo PRIME """
+        return int.from_bytes(hashlib.shake_256(item).digest(cls.BITS // 8), "little") % cls.PRIME
+
+    @staticmethod
+    def outputItem(txHash, txIdx, amount):
+        """ Serialize an unspent output for the set hash: its outpoint and amount """
+        return txHash.to_bytes(32, "big") + txIdx.to_bytes(32, "big") + amount.to_bytes(32, "big")
+
+    def add(self, item):
+        self.numerator = self.mulMod(self.numerator, self.element(item))
+        self.digestBytes = None
+
+    def remove(self, item):
+        self.denominator = self.mulMod(self.denominator, self.element(item))
+        self.digestBytes = None
+
+    def combined(self, other):
+        """ Return the hash of this multiset with other's changes applied """
+        return MuHash(self.mulMod(self.numerator, other.numerator), self.mulMod(self.denominator, other.denominator))
+
+    def digest(self):
+        """ Return the hash as a Hash32 """
+        if self.digestBytes == None:
+            value = self.mulMod(self.numerator, pow(self.denominator, -1, self.PRIME))
+            self.digestBytes = Hash32(hashlib.sha256(value.to_bytes(self.BITS // 8, "little")).digest())
+        return self.digestBytes
+
 
 class HashableMerkleTree:
     """ A merkle tree of hashable objects.
@@ -208,32 +765,57 @@ class HashableMerkleTree:
 
     def calcMerkleRoot(self):
         """ Calculate the merkle root of this tree."""
+        return int.from_bytes(self.calcMerkleRootBytes(), "big")
 
+    def calcMerkleRootBytes(self):
+        """ Calculate the merkle root of this tree as a Hash32.  The levels are hashed as raw digests. """
         # Hard code the degenerate case
         if len(self.hashables)==0:
-            return 0
-        
-        leafNodes = []
-        
-        for i in range(len(self.hashables)):
-            leafNodes.append(self.hashables[i].getHash())
-        
-        while len(leafNodes) > 1:
-            newLeaves = []
+            return ZERO_HASH
+
+        leafNodes = [leafHash(h) for h in self.hashables]
 
+        while len(leafNodes) > 1:
             if len(leafNodes)%2!=0:  # adding 0 to levels with odd # of elements
-                # zero = 0
-                leafNodes.append(0)
+                leafNodes.append(ZERO_HASH)
+            sha256 = hashlib.sha256
+            leafNodes = [sha256(leafNodes[i] + leafNodes[i+1]).digest() for i in range(0, len(leafNodes), 2)]
+
+        return Hash32(leafNodes[0])
+
+    def getProof(self, index):
+        """ Return the merkle proof of the item at index: the digest of its sibling at every level, leaf level first """
+        level = [leafHash(h) for h in self.hashables]
+        proof = []
+        while len(level) > 1:
+            if len(level)%2!=0:
+                level.append(ZERO_HASH)
+            proof.append(level[index ^ 1])
+            sha256 = hashlib.sha256
+            level = [sha256(level[i] + level[i+1]).digest() for i in range(0, len(level), 2)]
+            index //= 2
+        return proof
+
+
+def verifyMerkleProof(leaf, index, proof, merkleRoot):
+    """ Return True if proof (see HashableMerkleTree.getProof) shows that leaf, a 32 byte digest,
+        is the item at index of a merkle tree with root merkleRoot (an integer) """
+    node = leaf
+    for sibling in proof:
+        if index%2==0:
+            node = hashlib.sha256(node + sibling).digest()
+        else:
+            node = hashlib.sha256(sibling + node).digest()
+        index //= 2
+    return index == 0 and int.from_bytes(node, "big") == merkleRoot
 
-            for i in range(0, len(leafNodes), 2):
-                hxy = leafNodes[i].to_bytes(32, "big") + leafNodes[i+1].to_bytes(32, "big")
-                msg = hashlib.sha256()
-                msg.update(hxy)
-                newLeaves.append(int.from_bytes(msg.digest(), "big"))
-            
-            leafNodes = newLeaves
 
-        return leafNodes[0]
+def leafHash(hashable):
+    """ Return the hash of a merkle tree item as 32 bytes, without going through an integer if it can """
+    hashDigest = getattr(hashable, "hashDigest", None)
+    if hashDigest != None:
+        return hashDigest()
+    return hashable.getHash().to_bytes(32, "big")
 
 
 class BlockContents:
@@ -243,15 +825,151 @@ class BlockContents:
     """
     def __init__(self):
         self.data = HashableMerkleTree()
+        self.merkleRoot = None   # memoized calcMerkleRoot, reset by setData
 
     def setData(self, d):
+        """ Set the contents, freezing the transactions in it (see Transaction.freeze) """
+        if hasTransactions(d):
+            for txn in d:
+                if type(txn) == Transaction:
+                    txn.freeze()
         self.data = d
+        self.merkleRoot = None
 
     def getData(self):
         return self.data
 
     def calcMerkleRoot(self):
-        return self.data.calcMerkleRoot()
+        if type(self.data) == HashableMerkleTree:
+            # its list of hashables can be changed in place, so it is not memoized
+            return self.data.calcMerkleRoot()
+        if self.merkleRoot == None:
+            # a plain list of transactions (Block.setContents), or None
+            self.merkleRoot = HashableMerkleTree(self.data if hasTransactions(self.data) else None).calcMerkleRoot()
+        return self.merkleRoot
+
+
+class LazyBlockContents(BlockContents):
+    """ Block contents that live in a ContentCache (and its backing store) instead of in the block.
+        getData() loads them on first access; the block only keeps its header fields resident.
+    """
+    def __init__(self, cache, blockHash, merkleRoot=None):
+        self.cache = cache
+        self.blockHash = blockHash
+        self.merkleRoot = merkleRoot
+
+    def setData(self, d):
+        self.cache.put(self.blockHash, d)
+        self.merkleRoot = None
+
+    def getData(self):
+        return self.cache.get(self.blockHash)
+
+    def calcMerkleRoot(self):
+        if self.merkleRoot == None:
+            self.merkleRoot = HashableMerkleTree(self.getData()).calcMerkleRoot()
+        return self.merkleRoot
+
+class MemoryContentStore:
+    """ Keeps serialized block contents in memory, zlib compressed """
+    def __init__(self):
+        self.blobs = {}
+
+    def put(self, blockHash, data):
+        self.blobs[blockHash] = zlib.compress(data)
+
+    def get(self, blockHash):
+        return zlib.decompress(self.blobs[blockHash])
+
+    def discard(self, blockHash):
+        self.blobs.pop(blockHash, None)
+
+
+class DiskContentStore:
+    """ Keeps serialized block contents on disk, one zlib compressed file per block in directory """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, blockHash):
+        return os.path.join(self.directory, "%064x.blk" % blockHash)
+
+    def put(self, blockHash, data):
+        with open(self.path(blockHash), "wb") as f:
+            f.write(zlib.compress(data))
+
+    def get(self, blockHash):
+        with open(self.path(blockHash), "rb") as f:
+            return zlib.decompress(f.read())
+
+    def discard(self, blockHash):
+        if os.path.exists(self.path(blockHash)):
+            os.remove(self.path(blockHash))
+
+
+class ContentCache:
+    """ A size bounded LRU cache of block contents (transaction lists) in front of a backing store.
+        Contents are serialized with dill (constraint lambdas included) when stored; the size of
+        an entry is its serialized length, and the least recently used entries are evicted once
+        the total goes over maxBytes.  hits, misses and evictions count cache activity.
+    """
+    def __init__(self, store=None, maxBytes=64 * 1024 * 1024):
+        self.store = store if store != None else MemoryContentStore()
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()   # block hash -> (contents, size), least recently used first
+        self.currentBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def put(self, blockHash, contents):
+        """ Write contents to the backing store and keep them cached """
+        data = dill.dumps(contents)
+        self.store.put(blockHash, data)
+        with self.lock:
+            self.insert(blockHash, contents, len(data))
+
+    def get(self, blockHash):
+        """ Return the contents of a block, loading them from the backing store on a miss """
+        with self.lock:
+            entry = self.entries.get(blockHash)
+            if entry != None:
+                self.hits += 1
+                self.entries.move_to_end(blockHash)
+                return entry[0]
+            self.misses += 1
+
+        data = self.store.get(blockHash)
+        contents = dill.loads(data)
+        with self.lock:
+            self.insert(blockHash, contents, len(data))
+        return contents
+
+    def insert(self, blockHash, contents, size):
+        if blockHash in self.entries:
+            self.currentBytes -= self.entries.pop(blockHash)[1]
+        self.entries[blockHash] = (contents, size)
+        self.currentBytes += size
+        # always keep the newest entry, even if it alone is bigger than maxBytes
+        while self.currentBytes > self.maxBytes and len(self.entries) > 1:
+            oldHash, (oldContents, oldSize) = self.entries.popitem(last=False)
+            self.currentBytes -= oldSize
+            self.evictions += 1
+
+    def discard(self, blockHash):
+        """ Forget a block's contents, in the cache and in the backing store """
+        with self.lock:
+            if blockHash in self.entries:
+                self.currentBytes -= self.entries.pop(blockHash)[1]
+        self.store.discard(blockHash)
+
+    def getStats(self):
+        """ Return the cache metrics as a dictionary """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self.entries), "bytes": self.currentBytes, "maxBytes": self.maxBytes}
+
 
 class Block:
     """ This class should represent a blockchain block.
@@ -275,6 +993,12 @@ class Block:
         self.children = []
         self.cumulativeWork = 0
         self.height = 0
+        self.stats = NO_BLOCK_STATS   # set by Blockchain once validated, see calcStats
+        self.utxoDelta = None         # and the same for calcUtxoDelta (None: no change)
+
+        # memoized hash: (header fields it was computed from, digest, integer hash), see memoizedHash
+        self.hashMemo = None
+        self.frozen = False
 
     def getContents(self):
         """ Return the BlockContents """
@@ -287,6 +1011,7 @@ class Block:
     def setTarget(self, target):
         """ Set the difficulty target of this block """
         self.target = target
+        self.unfreeze()
 
     def getTarget(self):
         """ Return the difficulty target of this block """
@@ -294,6 +1019,39 @@ class Block:
 
     def getHash(self):
         """ Calculate the hash of this block. Return as an integer """
+        return self.memoizedHash()[2]
+
+    def getHashBytes(self):
+        """ Calculate the hash of this block as a Hash32 """
+        return Hash32(self.memoizedHash()[1])
+
+    def hashDigest(self):
+        return self.memoizedHash()[1]
+
+    def memoizedHash(self):
+        """ Return (header fields, digest, integer hash).  The hash is only recomputed when a header field
+            changed since the last call; once the block is frozen (connected to a chain) the fields are not
+            even compared.  The setters unfreeze the block, assigning header fields of a frozen block directly
+            is not supported. """
+        memo = self.hashMemo
+        if self.frozen:
+            return memo
+        fields = (self.version, self.parentBlockHash, self.target, self.time, self.nonce)
+        if memo == None or memo[0] != fields:
+            digest = self.computeDigest()
+            memo = self.hashMemo = (fields, digest, int.from_bytes(digest, "big"))
+        return memo
+
+    def freeze(self):
+        """ Stop checking the header fields for changes before returning the memoized hash """
+        self.memoizedHash()
+        self.frozen = True
+        return self
+
+    def unfreeze(self):
+        self.frozen = False
+
+    def computeDigest(self):
         # using following attributes to find the block hash
         # version, priorBlockHash, target, time and nonce
         blockHash = hashlib.sha256()
@@ -302,83 +1060,577 @@ class Block:
         blockHash.update(self.target.to_bytes(32,"big"))
         blockHash.update(self.time.to_bytes(32,"big"))
         blockHash.update(self.nonce.to_bytes(32,"big"))
-
-        return int.from_bytes(blockHash.digest(),"big")
+        return blockHash.digest()
 
     def setPriorBlockHash(self, priorHash):
         """ Assign the parent block hash """
         self.parentBlockHash = priorHash
+        self.unfreeze()
 
     def getPriorBlockHash(self):
         """ Return the parent block hash """
         return self.parentBlockHash
 
+    def getMerkleRoot(self):
+        """ Return the merkle root of this block's transactions (0 if it has none) """
+        return self.blockContents.calcMerkleRoot()
+
+    def getHeader(self):
+        """ Return a BlockHeader with this block's header fields and merkle root """
+        return BlockHeader(self.version, self.parentBlockHash, self.target, self.time, self.nonce, self.getMerkleRoot())
+
+    def getInclusionProof(self, txIdx):
+        """ Return the merkle proof of the transaction at txIdx in this block (see verifyMerkleProof) """
+        return HashableMerkleTree(self.getContents()).getProof(txIdx)
+
     def mine(self,tgt):
         """Modify this block until its hash is less than the passed target tgt"""
-        self.target = tgt
-
-        blockHash = self.getHash()
-        ct = 1
+        self.setTarget(tgt)
 
         # keep changing nonce value until blockHash is less than or equal to target
-        while blockHash > tgt:
+        while not Hash32(self.hashDigest()).meetsTarget(tgt):
             self.nonce += random.randint(1, 2**64) # pick a random integer between 0 and 2^64
-            blockHash = self.getHash()
-            # print("Try %d" %(ct))
-            ct += 1
-        
-        # print("Mined the block with nonce = %d" %(self.nonce))
 
 
-    def validate(self, unspentOutputs, maxMint):
+    def validate(self, unspentOutputs, maxMint, skipScripts=False):
         """ Given a dictionary of unspent outputs, and the maximum amount of
             coins that this block can create, determine whether this block is valid.
-            Return None if the block is invalid.
+            Return False if the block is invalid, True if it is valid.
 
-            Return something else if the block is valid 
-
-            HINT: you may want to return a new unspent output object with the transactions in this
-            block applied, for your own use when implementing other APIs.
+            The checks run cheapest first (proof of work, structure, amounts, constraint scripts)
+            and stop at the first failure.  skipScripts leaves out the constraint scripts, for blocks
+            that are already known to be valid (see Blockchain assumeValid).
+        """
+        return (self.validateProofOfWork() and self.validateStructure()
+                and self.validateAmounts(unspentOutputs, maxMint)
+                and (skipScripts or self.validateScripts(unspentOutputs)))
+
+    def validateProofOfWork(self):
+        """ Check that the target is in range and that the block hash meets it """
+        return 0 < self.target <= MAX_TARGET and Hash32(self.hashDigest()).meetsTarget(self.target)
+
+    def validateStructure(self):
+        """ Check the shape of the block without looking at any unspent outputs:
+            the first (and only the first) transaction is a mint, and no outpoint is spent twice in the block.
+            A block with no transactions is valid.
         """
+        blockTransactions = self.getContents()
+        if not hasTransactions(blockTransactions) or len(blockTransactions) == 0:
+            return True
+
         # First transaction in the block should be coinbase transaction 
-        # coinbase transaction should be less than or equal to maxMint 
-        # input transactions are from unspent transactions 
-        
-        if type(self.blockContents.getData())!=HashableMerkleTree():
-            blockTransactions = self.blockContents.getData()
-            # print("# of txns in block: ", len(blockTransactions))
-            coinbaseTransaction = blockTransactions[0]
-            mintAmount = coinbaseTransaction.outputs[0].amount 
-            # print("Coinbase Transaction : ", coinbaseTransaction)
-
-            if coinbaseTransaction.inputs != [] or mintAmount > maxMint: # input of coinbase transaction should be None 
-                # print("Mint amount error")
-                return False 
-            
-            for i in range(1, len(blockTransactions)):
-                transaction = blockTransactions[i]
-                if transaction.inputs==[]: # double mint transaction 
+        if blockTransactions[0].inputs != []:
+            return False
+
+        spent = set()
+        for i in range(1, len(blockTransactions)):
+            transaction = blockTransactions[i]
+            if transaction.inputs == []: # double mint transaction 
+                return False
+            for input in transaction.inputs:
+                outpoint = (input.txHash, input.txIdx)
+                if outpoint in spent:  # double spend inside this block
+                    return False
+                spent.add(outpoint)
+
+        return True
+
+    def validateMint(self, maxMint):
+        """ Check that the mint transaction does not create more than maxMint coins """
+        blockTransactions = self.getContents()
+        if not hasTransactions(blockTransactions) or len(blockTransactions) == 0:
+            return True
+        return blockTransactions[0].validateMint(maxMint)
+
+    def validateAmounts(self, unspentOutputs, maxMint):
+        """ Check the mint amount, and that every spending transaction only uses unspent outputs
+            and does not create coins.  Assumes validateStructure passed. """
+        if not self.validateMint(maxMint):
+            return False
+        blockTransactions = self.getContents()
+        if not hasTransactions(blockTransactions):
+            return True
+        spent = set()
+        for i in range(1, len(blockTransactions)):
+            if not blockTransactions[i].validateAmounts(unspentOutputs):
+                return False
+            # an output can only be spent once, also within a block
+            for input in blockTransactions[i].inputs:
+                if (input.txHash, input.txIdx) in spent:
+                    return False
+                spent.add((input.txHash, input.txIdx))
+        return True
+
+    def calcStats(self, unspentOutputs):
+        """ Return what this block adds to the chain totals, in BLOCK_STATS order: the number of transactions,
+            outputs created and outputs spent, the coins minted, and the coins burned (the value of the inputs
+            that spending transactions do not pass on to their outputs).  Assumes validateAmounts passed. """
+        blockTransactions = self.getContents()
+        if not hasTransactions(blockTransactions) or len(blockTransactions) == 0:
+            return NO_BLOCK_STATS
+        outputs, spent, burned = 0, 0, 0
+        for txn in blockTransactions:
+            outputs += len(txn.outputs)
+            spent += len(txn.inputs)
+            for input in txn.inputs:
+                burned += unspentOutputs[(input.txHash, input.txIdx)].amount
+        minted = sum(output.amount for output in blockTransactions[0].outputs)
+        for i in range(1, len(blockTransactions)):
+            burned -= sum(output.amount for output in blockTransactions[i].outputs)
+        return (len(blockTransactions), outputs, spent, minted, burned)
+
+    def calcUtxoDelta(self, unspentOutputs):
+        """ Return the change this block makes to the unspent output set as a MuHash: the outputs it creates
+            added, the outputs it spends removed.  Return None for a block without transactions.
+            Assumes validateAmounts passed. """
+        blockTransactions = self.getContents()
+        if not hasTransactions(blockTransactions) or len(blockTransactions) == 0:
+            return None
+        delta = MuHash()
+        for txn in blockTransactions:
+            for input in txn.inputs:
+                delta.remove(MuHash.outputItem(input.txHash, input.txIdx, unspentOutputs[(input.txHash, input.txIdx)].amount))
+            txHash = txn.getHash()
+            for idx, output in enumerate(txn.outputs):
+                delta.add(MuHash.outputItem(txHash, idx, output.amount))
+        return delta
+
+    def validateScripts(self, unspentOutputs):
+        """ Run the constraint scripts of all spending transactions.  Assumes validateAmounts passed. """
+        blockTransactions = self.getContents()
+        if not hasTransactions(blockTransactions):
+            return True
+        for i in range(1, len(blockTransactions)):
+            if not blockTransactions[i].validateScripts(unspentOutputs):
+                return False
+        return True
+
+
+class BlockHeader:
+    """ The header fields of a block without its transactions, for a headers-only Blockchain.
+        merkleRoot is the merkle root of the block's transactions, or 0 if it has none or it is not known.
+        Like the transactions, it is not covered by the block hash.
+        __slots__ keeps a header (and its chain bookkeeping) at a small fixed size.
+    """
+    __slots__ = ("version", "parentBlockHash", "target", "time", "nonce", "merkleRoot",
+                 "children", "cumulativeWork", "height", "stats", "utxoDelta", "hashMemo", "frozen")
+
+    def __init__(self, version=0, parentBlockHash=0, target=8, time=3, nonce=1, merkleRoot=0):
+        self.version = version
+        self.parentBlockHash = parentBlockHash
+        self.target = target
+        self.time = time
+        self.nonce = nonce
+        self.merkleRoot = merkleRoot
+        self.children = []
+        self.cumulativeWork = 0
+        self.height = 0
+        self.stats = NO_BLOCK_STATS
+        self.utxoDelta = None
+        self.hashMemo = None
+        self.frozen = False
+
+    def getContents(self):
+        """ A header carries no transactions """
+        return None
+
+    def getMerkleRoot(self):
+        return self.merkleRoot
+
+    # the block hash only covers the header, so these work the same as for a Block
+    getHash = Block.getHash
+    getHashBytes = Block.getHashBytes
+    hashDigest = Block.hashDigest
+    memoizedHash = Block.memoizedHash
+    computeDigest = Block.computeDigest
+    freeze = Block.freeze
+    unfreeze = Block.unfreeze
+    setTarget = Block.setTarget
+    getTarget = Block.getTarget
+    setPriorBlockHash = Block.setPriorBlockHash
+    getPriorBlockHash = Block.getPriorBlockHash
+    mine = Block.mine
+    validateProofOfWork = Block.validateProofOfWork
+
+
+class BlockFilter:
+    """ A compact Golomb-coded set of the items a block touches, so a light client can ask
+        "might this block involve any of my outpoints?" without downloading its transactions.
+
+        The items are the outpoints the block creates and spends, as (txHash, txIdx) tuples,
+        and the data field of every transaction.  Each item is hashed (keyed by the block hash)
+        into the range [0, N*FILTER_M), the sorted values are delta encoded, and every delta is
+        written as a Golomb-Rice code with FILTER_P remainder bits.  Matching has a false positive
+        rate of about 1/FILTER_M and no false negatives.
+    """
+    FILTER_P = 19
+    FILTER_M = 784931
+
+    def __init__(self, blockHash, encoded=b"\x00\x00\x00\x00"):
+        """ Wrap an encoded filter: 4 bytes item count followed by the Golomb-Rice bit stream """
+        self.key = blockHash.to_bytes(32, "big")[:16]
+        self.encoded = encoded
+        self.n = int.from_bytes(encoded[:4], "big")
+
+    @staticmethod
+    def blockItems(block):
+        """ Return the filter items of a block """
+        items = []
+        blockTxns = block.getContents()
+        if not hasTransactions(blockTxns):
+            return items
+        for txn in blockTxns:
+            txHash = txn.getHash()
+            for idx in range(len(txn.outputs)):
+                items.append((txHash, idx))
+            for input in txn.inputs:
+                items.append((input.txHash, input.txIdx))
+            if txn.data != None:
+                items.append(txn.data)
+        return items
+
+    @staticmethod
+    def itemBytes(item):
+        """ Serialize a filter item: an outpoint tuple, bytes, a string, or any other data value (as canonical JSON) """
+        if type(item) == tuple:
+            return item[0].to_bytes(32, "big") + item[1].to_bytes(4, "big")
+        if type(item) == str:
+            return item.encode()
+        if isinstance(item, (bytes, bytearray, memoryview)):
+            return bytes(item)
+        return json.dumps(item, sort_keys=True, separators=(",", ":"), default=repr).encode()
+
+    def hashItem(self, item, n):
+        """ Map an item uniformly into [0, n*FILTER_M) """
+        h = int.from_bytes(hashlib.blake2b(self.itemBytes(item), digest_size=8, key=self.key).digest(), "big")
+        return (h * n * self.FILTER_M) >> 64
+
+    @classmethod
+    def build(cls, block, blockHash):
+        """ Create the filter for a block """
+        flt = cls(blockHash)
+        items = set(cls.itemBytes(item) for item in cls.blockItems(block))
+        n = len(items)
+        # duplicate values are kept (as zero deltas), so the stored count stays n and queries hash into the same range
+        values = sorted(flt.hashItem(item, n) for item in items)
+
+        bits = []
+        last = 0
+        for value in values:
+            delta = value - last
+            last = value
+            bits.append("1" * (delta >> cls.FILTER_P) + "0" + format(delta & ((1 << cls.FILTER_P) - 1), "0%db" % cls.FILTER_P))
+        bits = "".join(bits)
+        # pad to a whole number of bytes; padding is never read because the count of values is known
+        bits += "0" * (-len(bits) % 8)
+        body = int(bits, 2).to_bytes(len(bits) // 8, "big") if bits else b""
+
+        flt.n = n
+        flt.encoded = flt.n.to_bytes(4, "big") + body
+        return flt
+
+    def values(self):
+        """ Yield the sorted hashed values stored in this filter """
+        body = self.encoded[4:]
+        bits = format(int.from_bytes(body, "big"), "0%db" % (len(body) * 8)) if body else ""
+        pos = 0
+        value = 0
+        for i in range(self.n):
+            end = bits.index("0", pos)
+            quotient = end - pos
+            pos = end + 1
+            value += (quotient << self.FILTER_P) + int(bits[pos:pos + self.FILTER_P], 2)
+            pos += self.FILTER_P
+            yield value
+
+    def matchAny(self, items):
+        """ Return True if any of items may be in this filter (False means definitely none are) """
+        if self.n == 0:
+            return False
+        wanted = sorted(set(self.hashItem(item, self.n) for item in items))
+        if not wanted:
+            return False
+        i = 0
+        for value in self.values():
+            while wanted[i] < value:
+                i += 1
+                if i == len(wanted):
                     return False
+            if wanted[i] == value:
+                return True
+        return False
+
+    def match(self, item):
+        """ Return True if item may be in this filter """
+        return self.matchAny([item])
+
+    def getHash(self):
+        """ Return the sha256 hash of the encoded filter as an integer """
+        return int.from_bytes(hashlib.sha256(self.encoded).digest(), "big")
+
+
+class UtxoView(Mapping):
+    """ An immutable { (txHash, offset) : Output } mapping of the outputs unspent at one tip (spent ones removed).
+
+        It is a base dict plus a dict of changes made since (None marks a removed output); neither is modified once
+        the view exists, so readers on other threads need no lock.  updated() returns a new view with more changes,
+        copying only the changes dict, and folds them into a fresh base once they get large compared to it, so a
+        tip move costs about as much as the outputs it touches.
+    """
+    MIN_CHANGES = 64
+
+    def __init__(self, base=None, changes=None, count=None):
+        self.base = {} if base is None else base
+        self.changes = {} if changes is None else changes
+        self.count = len(self.base) if count is None else count
+
+    def get(self, key, default=None):
+        if key in self.changes:
+            output = self.changes[key]
+            return default if output is None else output
+        return self.base.get(key, default)
+
+    def __getitem__(self, key):
+        output = self.get(key)
+        if output is None:
+            raise KeyError(key)
+        return output
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for key in self.base:
+            if key not in self.changes:
+                yield key
+        for key, output in self.changes.items():
+            if output is not None:
+                yield key
+
+    def updated(self, changes):
+        """ Return a new view with changes ({ key : Output, or None to remove it }) applied """
+        count = self.count
+        for key, output in changes.items():
+            count += (output is not None) - (key in self)
+        merged = dict(self.changes)
+        merged.update(changes)
+        if len(merged) <= max(self.MIN_CHANGES, len(self.base) // 4):
+            return UtxoView(self.base, merged, count)
+        base = dict(self.base)
+        for key, output in merged.items():
+            if output is None:
+                base.pop(key, None)
+            else:
+                base[key] = output
+        return UtxoView(base, None, count)
+
+
+class ChainSnapshot:
+    """ A consistent, read-only view of the blockchain at one tip.
+        Blockchain publishes a new snapshot every time its tip moves; readers on other threads take the
+        current one with Blockchain.getSnapshot() and can use it without any locking while extend runs.
+    """
+    def __init__(self, tip, activeChain, statsHistory, utxoHashes, utxos):
+        """ activeChain is the list of active chain blocks by height; the writer only ever appends to it
+            past this tip, or replaces it with a new list on a reorg, so heights 0..tip.height never change.
+            statsHistory holds one array per BLOCK_STATS field with the running total at each height (a list once
+            a total no longer fits in 64 bits), and
+            utxoHashes the MuHash of the unspent output set at each height; both are updated the same way.
+            utxos is the UtxoView of the outputs unspent at this tip. """
+        self.tip = tip
+        self.height = tip.height
+        self.cumulativeWork = tip.cumulativeWork
+        self.activeChain = activeChain
+        self.statsHistory = statsHistory
+        self.utxoHashes = utxoHashes
+        self.utxos = utxos
+
+    def getTip(self):
+        """ Return the tip block of this snapshot """
+        return self.tip
+
+    def getBlockAtHeight(self, height):
+        """ Return the active chain block at the passed height, or None if it is above the tip """
+        if height < 0 or height > self.height:
+            return None
+        return self.activeChain[height]
+
+    def getUnspentOutputs(self):
+        """ Return the outputs unspent at the tip (spent ones removed) as a read-only { (txHash, offset) : Output }
+            UtxoView, the same set Blockchain.getUnspentOutput reads """
+        return self.utxos
+
+    def getChainStats(self):
+        """ Return the totals of the active chain up to this tip as a dictionary: the BLOCK_STATS fields
+            plus "utxos" (outputs not spent) and "supply" (coins minted and not burned) """
+        stats = dict((name, values[self.height]) for name, values in zip(BLOCK_STATS, self.statsHistory))
+        stats["height"] = self.height
+        stats["utxos"] = stats["outputs"] - stats["spent"]
+        stats["supply"] = stats["minted"] - stats["burned"]
+        return stats
+
+    def getStatsHistory(self, name):
+        """ Return an array with the value of one getChainStats field at every height from 0 to this tip
+            (a list if the values do not fit in 64 bits) """
+        if name == "utxos":
+            return compactHistory(map(int.__sub__, self.getStatsHistory("outputs"), self.getStatsHistory("spent")))
+        if name == "supply":
+            return compactHistory(map(int.__sub__, self.getStatsHistory("minted"), self.getStatsHistory("burned")))
+        return self.statsHistory[BLOCK_STATS.index(name)][:self.height + 1]
+
+    def getUtxoCommitment(self, height=None):
+        """ Return the 32 byte hash of the unspent output set (outputs created and not spent, with their
+            amounts) at height on the active chain (default: the tip), or None above the tip.
+            Two chains with the same unspent outputs have the same commitment, whatever blocks led there. """
+        if height == None:
+            height = self.height
+        if height < 0 or height > self.height:
+            return None
+        return self.utxoHashes[height].digest()
+
+
+class ChainEvent:
+    """ A change to the active chain, delivered to ChainSubscriptions.
+        kind is "blockConnected" or "blockDisconnected" (block joined or left the active chain),
+        or "tipChanged", where block is the new tip and oldTip, disconnected (old tip first) and
+        connected (lowest first) describe the reorg path.
+    """
+    def __init__(self, kind, block, oldTip=None, disconnected=(), connected=()):
+        self.kind = kind
+        self.block = block
+        self.oldTip = oldTip
+        self.disconnected = disconnected
+        self.connected = connected
+
+    def __repr__(self):
+        return "ChainEvent(%s, %x)" % (self.kind, self.block.getHash())
+
 
-                # validate the current transaction using Transaction.validate(UtxO)
-                if not transaction.validate(unspentOutputs):
-                    return False 
+class ChainSubscription:
+    """ A consumer of ChainEvents, created by Blockchain.subscribe.
 
-                for input in transaction.inputs:
-                    if (input.txHash, input.txIdx) not in unspentOutputs:  # check for bogus transaction inputs
-                        # print("Bogus Input error for txn %d\n" %(i+1))
-                        return False 
+        Events go through a bounded queue, so extend only ever does a non-blocking put.  If the
+        consumer falls more than maxQueue events behind, further events are dropped and counted
+        in dropped (lagging becomes True) instead of stalling the chain.
 
-                    
-        return True 
+        Consume with get(), a blocking "for event in subscription" loop, "async for", or pass a
+        callback, which is then called for every event on a dedicated delivery thread.  "async for" waits
+        on the event loop itself (push wakes it with call_soon_threadsafe), so cancelling it is safe.
+    """
+    def __init__(self, chain, callback=None, maxQueue=1024):
+        self.chain = chain
+        self.queue = queue.Queue(maxQueue)
+        self.callback = callback
+        self.dropped = 0
+        self.callbackErrors = 0
+        self.closed = False
+        self.thread = None
+        self.waker = None   # (loop, asyncio.Event) of a waiting async consumer
+        if callback != None:
+            self.thread = threading.Thread(target=self.deliver, daemon=True)
+            self.thread.start()
+
+    @property
+    def lagging(self):
+        return self.dropped > 0
+
+    def push(self, event):
+        """ Queue an event without blocking; count it as dropped if the queue is full """
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+        self.wake()
+
+    def wake(self):
+        """ Wake the async consumer, if one is waiting """
+        waker = self.waker
+        if waker != None:
+            loop, ready = waker
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:   # its event loop is closed
+                pass
+
+    def get(self, timeout=None):
+        """ Wait for the next event.  Return None once the subscription is closed. """
+        return self.queue.get(timeout=timeout)
+
+    def deliver(self):
+        for event in self:
+            try:
+                self.callback(event)
+            except Exception:
+                self.callbackErrors += 1
+
+    def __iter__(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            yield event
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                # register before looking, so an event pushed in between still wakes us
+                ready = asyncio.Event()
+                self.waker = (loop, ready)
+                try:
+                    event = self.queue.get_nowait()
+                    break
+                except queue.Empty:
+                    await ready.wait()
+        finally:
+            self.waker = None
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    def close(self):
+        """ Stop receiving events and wake up any waiting consumer """
+        self.chain.unsubscribe(self)
+        self.closed = True
+        # make room for the end marker if the consumer is behind
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                break
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+        self.wake()
+        if self.thread != None and self.thread is not threading.current_thread():
+            self.thread.join()
 
 
 class Blockchain(object):
 
-    def __init__(self, genesisTarget, maxMintCoinsPerTx):
+    def __init__(self, genesisTarget, maxMintCoinsPerTx, assumeValid=None, contentCache=None, unspentOutputType=dict, headersOnly=False,
+                 finalityDepth=None):
         """ Initialize a new blockchain and create a genesis block.
             genesisTarget is the difficulty target of the genesis block (that you should create as part of this initialization).
             maxMintCoinsPerTx is a consensus parameter -- don't let any block into the chain that creates more coins than this!
+            assumeValid is the hash of a trusted block: the constraint scripts of it and its ancestors are not run
+            (everything else still is).  Its ancestry is learned with loadAssumeValidHeaders.
+            contentCache is an optional ContentCache: the transactions of connected blocks are moved into it and
+            loaded back on demand, so only block headers stay in memory.
+            unspentOutputType is the mapping class findUnspentOutputs builds its result in, e.g. UtxoTable for large sets.
+            headersOnly keeps only a BlockHeader per block: extend accepts Blocks or BlockHeaders, checks their proof
+            of work and selects the tip by cumulative work as usual, but never sees transactions.  Inclusion of a
+            transaction is checked on demand with verifyInclusion.
+            finalityDepth, if set, makes the active chain final below that many blocks under the tip: blocks that
+            would fork off below it are rejected, and side branches forking off below it are dropped from every
+            index (see collectStaleForks).
         """
         self.genesisTarget = genesisTarget
         self.maxMintCoinsPerTx = maxMintCoinsPerTx
@@ -387,15 +1639,61 @@ class Blockchain(object):
         self.blockChain = defaultdict(list)
         genesisBlock = Block()  # creating a genesis block
         genesisBlock.setTarget(genesisTarget)   # set the difficulty of the genesis block
+        if headersOnly:
+            genesisBlock = genesisBlock.getHeader()
+        self.headersOnly = headersOnly
         genesisBlock.cumulativeWork = 1   # work of genesis block is 1
         self.chain.append(genesisBlock)    # add genesis block to the chain
         self.root = genesisBlock
         self.blockHashMapping = defaultdict(Block)  # mapping between block hash and the block
-        self.blockHashMapping[self.root.getHash()] = self.root
+        self.blockHashMapping[self.root.freeze().getHash()] = self.root
 
         # pointer to chain tip and attribute which keeps track of maximum Work of any fork
         self.chainTip = self.root
         self.maxWork = self.root.cumulativeWork  
+
+        # extend and extendMany take this lock, readers use the snapshot instead
+        self.writeLock = threading.RLock()
+        # blocks of the active chain (the one ending at chainTip) by height
+        self.activeChain = [self.root]
+        self.statsHistory = [compactHistory([0]) for name in BLOCK_STATS]
+        self.utxoHashes = [MuHash()]
+        self.snapshot = ChainSnapshot(self.root, self.activeChain, self.statsHistory, self.utxoHashes, UtxoView())
+        # ChainSubscriptions to notify when the tip moves (replaced, never modified, so setTip can read it unlocked)
+        self.subscribers = ()
+
+        # block filters and filter headers, built on first request
+        self.blockFilters = {}
+        self.filterHeaders = {}
+
+        # assume-valid: hash -> merkle root of the trusted block and its known ancestors, and how many blocks skipped scripts
+        self.assumeValid = assumeValid
+        self.assumeValidAncestors = {}
+        self.assumedValidCount = 0
+
+        self.contentCache = contentCache
+        self.unspentOutputType = unspentOutputType
+
+        # number of blocks rejected by extend/extendMany, per validation stage
+        self.rejectionCounts = dict.fromkeys(VALIDATION_STAGES, 0)
+
+        # recently rejected blocks: hashes with a bad header (or a bad ancestor), and hash -> set of bad
+        # contents merkle roots; both keep at most maxInvalidBlocks entries, oldest dropped first
+        self.maxInvalidBlocks = 10000
+        self.invalidBlocks = OrderedDict()
+        self.invalidContents = OrderedDict()
+        # blocks extend dropped without validating: already connected, known invalid, or child of an invalid block
+        self.duplicateCounts = {"known": 0, "invalid": 0, "invalidParent": 0}
+
+        # finality: active chain blocks below finalHeight can't be forked from; blocks rejected for trying,
+        # and what collectStaleForks freed
+        self.finalityDepth = finalityDepth
+        self.finalHeight = 0
+        self.gcStats = {"rejectedBelowFinality": 0, "collectedBlocks": 0, "collectedTransactions": 0, "reclaimedBytes": 0}
+
+        # undo data for the UtxoView setTip publishes with each snapshot: per active chain block hash above
+        # finalHeight, the outputs it changed and their old values
+        self.utxoUndo = {}
         
     def getTip(self):
         """ Return the block at the tip (end) of the blockchain fork that has the largest amount of work"""
@@ -410,10 +1708,13 @@ class Blockchain(object):
     def getCumulativeWork(self, blkHash):
         """Return the cumulative work for the block identified by the passed hash.  Return None if the block is not in the blockchain"""
 
-        if blkHash not in self.blockHashMapping: # block is not present in Blockchain
+        # one .get: checking and then indexing the defaultdict could insert a blank Block if the block is
+        # collected in between (collectStaleForks)
+        block = self.blockHashMapping.get(blkHash)
+        if block == None: # block is not present in Blockchain
             return None 
         
-        return self.blockHashMapping[blkHash].cumulativeWork
+        return block.cumulativeWork
         
 
     def getBlocksAtHeight(self, height):
@@ -421,7 +1722,8 @@ class Blockchain(object):
         
         arrayOfBlocks = []
 
-        for blockHash, block in self.blockHashMapping.items():
+        # list() copies the blocks in one step, so a concurrent extend can't change the dict under us
+        for block in list(self.blockHashMapping.values()):
             if block.height==height:
                 arrayOfBlocks.append(block)
         
@@ -429,102 +1731,590 @@ class Blockchain(object):
 
     def extend(self, block):
         """Adds this block into the blockchain in the proper location.
-           Return false if the block is invalid (breaks any miner constraints), and do not add it to the blockchain."""
+           Return false if the block is invalid (breaks any miner constraints), and do not add it to the blockchain.
+           Also return false, without validating it again, if the block is already in the blockchain
+           or was rejected before (see getDuplicateCounts)."""
 
-        # find the parent block of given block
-        if block.parentBlockHash not in self.blockHashMapping:
-            return False 
-        
-        # print("Block %s contents = %s" %(block.getHash(), block.getContents()))
-        blockContents = block.getContents()
-        # print(type(blockContents))
-        parent = self.blockHashMapping[block.parentBlockHash]
-        
-        # validate blocks which have transactions, essentially used for TestBlockchainWithTransactions()
-        if blockContents != None and type(blockContents)!=type(HashableMerkleTree()):
-            
-            # print("# of ancestors for block %s: " %(block.getHash()))
-            unspentOutputs = self.findUnspentOutputs(parent)
-            
-            # print("Length of unspent outputs :", len(unspentOutputs))
-
-            if not block.validate(unspentOutputs, self.maxMintCoinsPerTx):
+        if self.headersOnly and type(block) != BlockHeader:
+            block = block.getHeader()
+
+        with self.writeLock:
+            blockHash = block.getHash()
+            if self.isSeen(block, blockHash):
+                return False
+
+            # find the parent block of given block
+            if block.parentBlockHash not in self.blockHashMapping:
+                self.rejectionCounts["orphan"] += 1
+                return False 
+
+            parent = self.blockHashMapping[block.parentBlockHash]
+            if parent.height < self.finalHeight:
+                self.gcStats["rejectedBelowFinality"] += 1
+                return False
+
+            if not self.checkBlock(block, blockHash, lambda: self.findUnspentOutputs(parent)):
                 return False
 
+            self.connectBlock(block, parent, blockHash)
+
+            # update the chain tip
+            if block.cumulativeWork > self.maxWork:
+                self.setTip(block)
+
+            return True # block is successfully added
+
+    def extendMany(self, blocks, maxOrphans=1024):
+        """ Add a batch of blocks, for example during initial sync.
+            blocks can be any iterable (a list, or a generator streaming them from disk) in any order:
+            a block whose parent has not arrived yet is held back until it does, keeping at most maxOrphans
+            of them (the oldest is dropped beyond that).
+            A run of consecutive blocks is validated against one rolling unspent output view instead of
+            rebuilding it for every block, and the tip is only selected once at the end of the batch.
+            Returns a list with the result extend would have given for each block, in input order.
+        """
+        with self.writeLock:
+            results = []
+            orphans = OrderedDict()         # input index -> (block, hash), oldest first
+            orphansByParent = defaultdict(list)  # parent hash -> [input index]
+
+            viewTip = None   # block whose transactions (and its ancestors') are applied to view
+            view = None
+            bestBlock = None
+            bestWork = self.maxWork
+
+            for block in blocks:
+                index = len(results)
+                results.append(False)
+                if self.headersOnly and type(block) != BlockHeader:
+                    block = block.getHeader()
+                blockHash = block.getHash()
+                if self.isSeen(block, blockHash):
+                    continue
+
+                if block.parentBlockHash not in self.blockHashMapping:
+                    orphans[index] = (block, blockHash)
+                    orphansByParent[block.parentBlockHash].append(index)
+                    if len(orphans) > maxOrphans:
+                        oldIndex, (oldBlock, oldHash) = orphans.popitem(last=False)
+                        siblings = orphansByParent[oldBlock.parentBlockHash]
+                        siblings.remove(oldIndex)
+                        if not siblings:   # don't keep an empty list for every evicted parent
+                            del orphansByParent[oldBlock.parentBlockHash]
+                        self.rejectionCounts["orphan"] += 1
+                    continue
+
+                pending = [(index, block, blockHash)]
+                while pending:
+                    index, block, blockHash = pending.pop()
+                    # a duplicate of a block connected earlier in the batch, or the child of a rejected one
+                    if self.isSeen(block, blockHash):
+                        continue
+                    parent = self.blockHashMapping[block.parentBlockHash]
+                    if parent.height < self.finalHeight:
+                        self.gcStats["rejectedBelowFinality"] += 1
+                        continue
+
+                    def parentView():
+                        nonlocal view, viewTip
+                        if viewTip is not parent:
+                            view = self.findUnspentOutputs(parent)
+                            viewTip = parent
+                        return view
+
+                    if not self.checkBlock(block, blockHash, parentView):
+                        if blockHash in self.invalidBlocks:
+                            # its waiting children are invalid too, let isSeen count them
+                            for childIndex in orphansByParent.pop(blockHash, []):
+                                child, childHash = orphans.pop(childIndex)
+                                pending.append((childIndex, child, childHash))
+                        continue
+                    if viewTip is parent:  # roll the view forward onto this block
+                        self.applyBlock(view, block)
+                        viewTip = block
+
+                    self.connectBlock(block, parent, blockHash)
+                    results[index] = True
+                    if block.cumulativeWork > bestWork:
+                        bestBlock = block
+                        bestWork = block.cumulativeWork
+
+                    # blocks that were waiting for this one can now be connected
+                    for childIndex in orphansByParent.pop(blockHash, []):
+                        child, childHash = orphans.pop(childIndex)
+                        pending.append((childIndex, child, childHash))
+
+            # blocks whose parent never arrived
+            self.rejectionCounts["orphan"] += len(orphans)
+
+            # deferred tip selection, same outcome as calling extend on each block in turn
+            if bestBlock is not None:
+                self.setTip(bestBlock)
+
+            return results
+
+    def setTip(self, block):
+        """ Make block the chain tip, update the active chain index and publish a new snapshot """
+        # walk back from the new tip to where it joins the active chain
+        path = []
+        fork = block
+        while fork.height >= len(self.activeChain) or self.activeChain[fork.height] is not fork:
+            path.append(fork)
+            fork = self.blockHashMapping[fork.parentBlockHash]
+        path.reverse()
+        oldTip = self.chainTip
+        disconnected = self.activeChain[oldTip.height:fork.height:-1]
+
+        # running totals at each connected block, worked out before any state changes
+        totals = [values[fork.height] for values in self.statsHistory]
+        added = []
+        for b in path:
+            totals = [total + value for total, value in zip(totals, b.stats)]
+            added.append(totals)
+
+        if fork is self.chainTip:
+            # plain extension: readers never look past their own tip, so appending in place is safe
+            self.activeChain.extend(path)
+        else:
+            # reorg: copy, so existing snapshots keep their view of the old chain
+            self.activeChain = self.activeChain[:fork.height + 1] + path
+            self.statsHistory = [values[:fork.height + 1] for values in self.statsHistory]
+            self.utxoHashes = self.utxoHashes[:fork.height + 1]
+
+        # the disconnected blocks were cut off above, add the connected ones
+        for i, column in enumerate(zip(*added)):
+            values = self.statsHistory[i]
+            if type(values) == array and type(compactHistory(column)) != array:
+                # a total outgrew 64 bits: keep plain ints from here on, in a new list so snapshots keep theirs
+                self.statsHistory = list(self.statsHistory)
+                values = self.statsHistory[i] = list(values)
+            values.extend(column)
+        for b in path:
+            self.utxoHashes.append(self.utxoHashes[-1].combined(b.utxoDelta) if b.utxoDelta != None else self.utxoHashes[-1])
+
+        # the unspent outputs are copied on write too, into a new view
+        utxos = self.snapshot.utxos
+        changes = {}
+        for b in disconnected:
+            self.disconnectUtxos(b, changes)
+        for b in path:
+            self.connectUtxos(b, utxos, changes)
+
+        self.chainTip = block
+        self.maxWork = block.cumulativeWork
+        self.snapshot = ChainSnapshot(block, self.activeChain, self.statsHistory, self.utxoHashes, utxos.updated(changes))
+
+        if self.subscribers:
+            events = [ChainEvent("blockDisconnected", b) for b in disconnected]
+            events += [ChainEvent("blockConnected", b) for b in path]
+            events.append(ChainEvent("tipChanged", block, oldTip, tuple(disconnected), tuple(path)))
+            for subscriber in self.subscribers:
+                for event in events:
+                    subscriber.push(event)
+
+        if self.finalityDepth != None:
+            self.collectStaleForks()
+
+    def collectStaleForks(self):
+        """ Move finalHeight up to finalityDepth blocks below the tip, and drop the side branches that fork off
+            the active chain below it: from blockHashMapping, the children lists, blockChain, the block filters
+            and the content cache.  Snapshots that still hold a dropped block can use its header, but not
+            contents that were in the content cache. """
+        newFinalHeight = self.chainTip.height - self.finalityDepth
+        if newFinalHeight <= self.finalHeight:
+            return
+
+        for height in range(self.finalHeight, newFinalHeight):
+            block = self.activeChain[height]
+            keep = self.activeChain[height + 1]
+            # final blocks are never disconnected
+            self.utxoUndo.pop(keep.getHash(), None)
+            if len(block.children) == 1:
+                continue
+            for child in block.children:
+                if child is not keep:
+                    self.discardBlock(child)
+                    for descendant in self.iterDescendants(child):
+                        self.discardBlock(descendant)
+            block.children = [keep]
+            self.blockChain[block] = [keep]
+        self.finalHeight = newFinalHeight
+
+    def discardBlock(self, block):
+        """ Remove a block from the indexes (not from its parent's children), counting what it held """
+        blockHash = block.getHash()
+        self.gcStats["collectedBlocks"] += 1
+        self.gcStats["reclaimedBytes"] += self.blockMemoryUsage(block)
+        self.gcStats["collectedTransactions"] += block.stats[0]
+        self.blockHashMapping.pop(blockHash, None)
+        self.blockChain.pop(block, None)
+        self.blockFilters.pop(blockHash, None)
+        self.filterHeaders.pop(blockHash, None)
+        if type(getattr(block, "blockContents", None)) == LazyBlockContents:
+            self.contentCache.discard(blockHash)
+
+    @staticmethod
+    def blockMemoryUsage(block):
+        """ Return the approximate number of bytes held by a block and its transactions, if they are resident """
+        size = sys.getsizeof(block) + sys.getsizeof(block.children)
+        if hasattr(block, "__dict__"):
+            size += sys.getsizeof(block.__dict__)
+        if block.utxoDelta != None:
+            size += sys.getsizeof(block.utxoDelta.numerator) + sys.getsizeof(block.utxoDelta.denominator)
+        if type(getattr(block, "blockContents", None)) == LazyBlockContents:
+            return size   # the contents are in the content cache, which keeps its own count
+        blockTxns = block.getContents()
+        if hasTransactions(blockTxns):
+            size += sys.getsizeof(blockTxns)
+            for txn in blockTxns:
+                size += sys.getsizeof(txn) + sys.getsizeof(txn.__dict__) + sys.getsizeof(txn.inputs) + sys.getsizeof(txn.outputs)
+                for item in txn.inputs + txn.outputs:
+                    size += sys.getsizeof(item) + sys.getsizeof(item.__dict__)
+        return size
+
+    def getGcStats(self):
+        """ Return the final height, the number of blocks rejected for forking off below it,
+            and what collectStaleForks has freed so far, as a dictionary """
+        stats = dict(self.gcStats)
+        stats["finalHeight"] = self.finalHeight
+        return stats
+
+    def subscribe(self, callback=None, maxQueue=1024):
+        """ Return a ChainSubscription that receives a ChainEvent for every block connected to or
+            disconnected from the active chain, and every tip change """
+        subscription = ChainSubscription(self, callback, maxQueue)
+        with self.writeLock:
+            self.subscribers = self.subscribers + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """ Stop sending events to subscription (ChainSubscription.close does this) """
+        with self.writeLock:
+            self.subscribers = tuple(s for s in self.subscribers if s is not subscription)
+
+    def getSnapshot(self):
+        """ Return an immutable ChainSnapshot of the current tip.  Never blocks, even while a block is being validated. """
+        return self.snapshot
+
+    def loadAssumeValidHeaders(self, headers):
+        """ Learn which blocks are ancestors of the assumeValid block.
+            headers is an iterable of blocks or BlockHeaders (only their header fields and merkle root are used),
+            e.g. the archive being synced; the ancestry is followed back from the trusted hash through the parent
+            hashes, so blocks that are not really its ancestors are ignored.  The merkle root of each ancestor is
+            remembered too: the block hash does not cover the transactions, so only a block with the same
+            transactions is trusted.  Return the number of ancestors found (the trusted block included).
+        """
+        if self.assumeValid == None:
+            return 0
+        parents = {}
+        for header in headers:
+            parents[header.getHash()] = (header.getPriorBlockHash(), header.getMerkleRoot())
+
+        with self.writeLock:
+            blockHash = self.assumeValid
+            while blockHash in parents and blockHash not in self.assumeValidAncestors:
+                parentHash, merkleRoot = parents[blockHash]
+                self.assumeValidAncestors[blockHash] = merkleRoot
+                blockHash = parentHash
+            return len(self.assumeValidAncestors)
+
+    def isAssumedValid(self, blockHash, merkleRoot=None):
+        """ Return True if the block is the assumeValid block or one of its ancestors, so its scripts need not run.
+            If merkleRoot is given, it must also match the one loaded with the header. """
+        if blockHash not in self.assumeValidAncestors:
+            return False
+        return merkleRoot == None or self.assumeValidAncestors[blockHash] == merkleRoot
+
+    def checkBlock(self, block, blockHash, getUnspentOutputs):
+        """ Validate block one stage at a time, cheapest first, and record the stage it fails at.
+            getUnspentOutputs is called for the parent's unspent outputs only once the proof of work and
+            structure checks pass, so junk blocks never cost an unspent output rebuild.
+            Return True if the block is valid.
+        """
+        if not block.validateProofOfWork():
+            return self.rejectBlock(block, blockHash, "pow")
+
+        # blocks without transactions have nothing else to check
+        if not hasTransactions(block.getContents()):
+            return True
+
+        if not block.validateStructure():
+            return self.rejectBlock(block, blockHash, "structure")
+
+        if not block.validateMint(self.maxMintCoinsPerTx):
+            return self.rejectBlock(block, blockHash, "amounts")
+
+        unspentOutputs = getUnspentOutputs()
+        if not block.validateAmounts(unspentOutputs, self.maxMintCoinsPerTx):
+            return self.rejectBlock(block, blockHash, "amounts")
+
+        if self.isAssumedValid(blockHash, block.getMerkleRoot()):
+            self.assumedValidCount += 1
+        elif not block.validateScripts(unspentOutputs):
+            return self.rejectBlock(block, blockHash, "scripts")
+
+        block.stats = block.calcStats(unspentOutputs)
+        block.utxoDelta = block.calcUtxoDelta(unspentOutputs)
+        return True
+
+    def rejectBlock(self, block, blockHash, stage):
+        """ Count a rejected block and remember it, so it is dropped without validation if it is sent again.
+            The block hash only covers the header, so a bad header (proof of work) condemns the hash, and
+            every block built on it, while bad structure or amounts only condemn that hash with that merkle root.
+            Script failures are not remembered: satisfiers are not part of the merkle root, so the same
+            block could come back with working ones.
+            Return False. """
+        self.rejectionCounts[stage] += 1
+        if stage == "pow":
+            self.rememberInvalid(self.invalidBlocks, blockHash, True)
+        elif stage != "scripts":
+            roots = self.invalidContents.get(blockHash) or set()
+            roots.add(block.blockContents.calcMerkleRoot())
+            self.rememberInvalid(self.invalidContents, blockHash, roots)
+        return False
+
+    def rememberInvalid(self, cache, blockHash, value):
+        cache[blockHash] = value
+        cache.move_to_end(blockHash)
+        while len(cache) > self.maxInvalidBlocks:
+            cache.popitem(last=False)
+
+    def isSeen(self, block, blockHash):
+        """ Return True (and count it) if block is already in the chain or known to be invalid,
+            so extend can drop it before any validation work """
+        if blockHash in self.blockHashMapping:
+            self.duplicateCounts["known"] += 1
+            return True
+        if blockHash in self.invalidBlocks:
+            self.duplicateCounts["invalid"] += 1
+            return True
+        if block.parentBlockHash in self.invalidBlocks:
+            # built on an invalid block, so invalid too
+            self.duplicateCounts["invalidParent"] += 1
+            self.rememberInvalid(self.invalidBlocks, blockHash, True)
+            return True
+        if blockHash in self.invalidContents and block.blockContents.calcMerkleRoot() in self.invalidContents[blockHash]:
+            self.duplicateCounts["invalid"] += 1
+            return True
+        return False
+
+    def getDuplicateCounts(self):
+        """ Return a copy of the number of blocks dropped because they were already known (valid or invalid) """
+        return dict(self.duplicateCounts)
+
+    def getChainStats(self):
+        """ Return the totals of the active chain at the current tip, see ChainSnapshot.getChainStats """
+        return self.getSnapshot().getChainStats()
+
+    def getUtxoCommitment(self, height=None):
+        """ Return the hash of the unspent output set at height, see ChainSnapshot.getUtxoCommitment """
+        return self.getSnapshot().getUtxoCommitment(height)
+
+    def getUnspentOutput(self, txHash, txIdx):
+        """ Return the Output at (txHash, txIdx) if it is unspent at the tip, else None.
+            Read from the current snapshot's getUnspentOutputs, without locking. """
+        return self.getSnapshot().getUnspentOutputs().get((txHash, txIdx))
+
+    def connectUtxos(self, block, utxos, changes):
+        """ Add what block does to the unspent outputs to changes (pending on top of the utxos view),
+            remembering how to undo it """
+        undo = []
+        blockTxns = block.getContents()
+        if hasTransactions(blockTxns):
+            # spends first, like applyBlock
+            for txn in blockTxns:
+                for input in txn.inputs:
+                    key = (input.txHash, input.txIdx)
+                    undo.append((key, changes[key] if key in changes else utxos.get(key)))
+                    changes[key] = None
+            for txn in blockTxns:
+                txHash = txn.getHash()
+                for idx, output in enumerate(txn.outputs):
+                    key = (txHash, idx)
+                    undo.append((key, changes[key] if key in changes else utxos.get(key)))
+                    changes[key] = output
+        if block.height > self.finalHeight:
+            self.utxoUndo[block.getHash()] = undo
+
+    def disconnectUtxos(self, block, changes):
+        """ Add the undoing of block's unspent output changes to changes """
+        for key, output in reversed(self.utxoUndo.pop(block.getHash())):
+            changes[key] = output
+
+    def getRejectionCounts(self):
+        """ Return a copy of the number of rejected blocks per validation stage """
+        return dict(self.rejectionCounts)
+
+    def connectBlock(self, block, parent, blockHash):
+        """ Link an already validated block below its parent (does not move the chain tip) """
         # update the "children" attribute of parent block
         parent.children.append(block) 
 
         # compute to cumulative work of the block as sum of its work plus cumulative work of its parent
         block.cumulativeWork = self.getWork(block.target) + parent.cumulativeWork
 
-        # update the chain tip
-        if block.cumulativeWork > self.maxWork:
-            self.chainTip = block
-            self.maxWork = block.cumulativeWork
-
         # update blockHashMapping 
-        self.blockHashMapping[block.getHash()] = block 
+        self.blockHashMapping[blockHash] = block 
+        block.freeze()
 
         # update the height of the block 
         block.height = parent.height + 1
 
-        
         # create a directed edge from parent to child - we can always access the parent of given through parentBlockHash of child
         self.blockChain[parent].append(block)
 
-        return True # block is successfully added
+        # hand the transactions over to the content cache, the block keeps only its header
+        if self.contentCache != None and hasTransactions(block.getContents()) and type(block.blockContents) != LazyBlockContents:
+            self.contentCache.put(blockHash, block.getContents())
+            block.blockContents = LazyBlockContents(self.contentCache, blockHash, block.blockContents.merkleRoot)
+
+    @staticmethod
+    def applyBlock(unspentOutputs, block):
+        """ Apply block to the unspentOutputs dictionary in place: remove the outputs its transactions spend,
+            then add the ones they create (the same view findUnspentOutputs builds, one block at a time) """
+        blockTxns = block.getContents()
+        if not hasTransactions(blockTxns):
+            return unspentOutputs
+
+        # every input refers to an output from before the block, so all spends go first
+        for txn in blockTxns:
+            for input in txn.inputs:
+                unspentOutputs.pop((input.txHash, input.txIdx), None)
+        for txn in blockTxns:
+            txHash = txn.getHash()
+            for idx, output in enumerate(txn.outputs):
+                unspentOutputs[(txHash, idx)] = output
+
+        return unspentOutputs
     
     def findUnspentOutputs(self, tempBlock):
+        """ Return the unspent outputs after tempBlock and all of its ancestors are applied, as
+            a dictionary of { (txHash, offset) : Output } """
+        # only the part of a side branch above the active chain is collected, the rest is streamed
+        snapshot = self.getSnapshot()
+        sideBranch = []
         temp = tempBlock
-        ancestors = []
-
-        # Traverse until the genesis block through priorBlockHash
-        while temp.getHash() != self.root.getHash():
-            ancestors.append(temp)
-            temp = self.blockHashMapping[temp.parentBlockHash]
-        
-        # Add genesis block as well 
-        # ancestors.append(self.root)  ->>>>> chuck genesis block for a while
-        
-        # Length of ancestors
-        # print("Ancestors for block: ", len(ancestors))
-
-        unspent = defaultdict(int)
-        
-        # genesisTransactions = ancestors[-1].getContents()
-
-        # if type(genesisTransactions)!=type([]):
-        #     print("Stuck hereee")
-        #     return dict()
-
-        # for txn in genesisTransactions:
-        #     idx = 0
-        #     for output in txn.outputs:
-        #         unspent[(txn.getHash(), idx)] = output
-        #         idx += 1
-
-        outputs = []
+        while snapshot.getBlockAtHeight(temp.height) is not temp:
+            sideBranch.append(temp)
+            # .get: indexing the defaultdict would insert a blank Block for a missing parent
+            temp = self.blockHashMapping.get(temp.parentBlockHash)
+            if temp is None:
+                raise KeyError("an ancestor of block %x is not in the blockchain" % tempBlock.getHash())
+
+        unspent = self.unspentOutputType()
+        for block in self.iterActiveChain(1, temp.height + 1, snapshot):  # from genesis to the fork point
+            self.applyBlock(unspent, block)
+        for block in reversed(sideBranch):
+            self.applyBlock(unspent, block)
+        return unspent
 
-        for i in range(len(ancestors)-1, -1, -1): # from genesis to parent block
-            block = ancestors[i]
+    def iterActiveChain(self, start=0, stop=None, snapshot=None):
+        """ Yield the active chain blocks from height start up to (not including) height stop, like range().
+            If start > stop they are yielded downwards, e.g. iterActiveChain(tip.height, -1) walks tip to genesis.
+            stop defaults to just past the tip.  The chain is read from one snapshot, so a reorg while iterating
+            does not mix two chains. """
+        if snapshot is None:
+            snapshot = self.getSnapshot()
+        if stop is None:
+            stop = snapshot.height + 1
+        if start <= stop:
+            heights = range(max(start, 0), min(stop, snapshot.height + 1))
+        else:
+            heights = range(min(start, snapshot.height), max(stop, -1), -1)
+        for height in heights:
+            yield snapshot.getBlockAtHeight(height)
+
+    def iterAncestors(self, block):
+        """ Yield the ancestors of block, its parent first and genesis last.  Stops early at an ancestor that is
+            not in the blockchain (e.g. a side branch collectStaleForks dropped). """
+        while block is not self.root:
+            block = self.blockHashMapping.get(block.parentBlockHash)
+            if block is None:
+                return
+            yield block
+
+    def iterDescendants(self, block):
+        """ Yield every block built on top of block, on all forks (depth first) """
+        stack = [iter(block.children)]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+                continue
+            yield child
+            stack.append(iter(child.children))
+
+    def iterTransactions(self, start=0, stop=None):
+        """ Yield (block, transaction) for every transaction in the active chain blocks iterActiveChain(start, stop) yields """
+        for block in self.iterActiveChain(start, stop):
             blockTxns = block.getContents()
-            # print("\n# of txns in block : ", len(blockTxns))
-            # for txn in blockTxns:
-            #     for input in txn.inputs:
-            #         if (input.txHash, tx.txIdx) in unspent: # delete spent outputs
-            #             del unspent[(input.txHash, tx.txIdx)]
-
-                # add outputs to unspent pool of transactions
-            for txn in blockTxns:
-                idx = 0
-                for output in txn.outputs:
-                    unspent[(txn.getHash(), idx)] = output
-                    idx += 1
-        
-        # print("\nUnspent Transactions: ", unspent)
-        # print()
-        # print()
-        return unspent
+            if hasTransactions(blockTxns):
+                for txn in blockTxns:
+                    yield block, txn
+
+    def getBlockFilter(self, blkHash):
+        """ Return the BlockFilter of the block identified by the passed hash, or None if the block is not in the blockchain """
+        block = self.blockHashMapping.get(blkHash)
+        if block is None:
+            return None
+        if blkHash not in self.blockFilters:
+            self.blockFilters[blkHash] = BlockFilter.build(block, blkHash)
+        return self.blockFilters[blkHash]
+
+    def getFilterHeader(self, blkHash):
+        """ Return the filter header of a block: sha256(filter hash + parent's filter header), with 0 before genesis.
+            Like block hashes, matching filter headers commit a client to the filters of every ancestor. """
+        block = self.blockHashMapping.get(blkHash)
+        if block is None:
+            return None
+
+        # walk back to the nearest ancestor with a known header, then fill in forwards
+        missing = []
+        blockHash = blkHash
+        while blockHash not in self.filterHeaders:
+            missing.append(blockHash)
+            if block is self.root:
+                break
+            blockHash = block.parentBlockHash
+            block = self.blockHashMapping.get(blockHash)
+            if block is None:   # an ancestor was collected
+                return None
+
+        # stopped at a known header, or went past genesis
+        prevHeader = self.filterHeaders.get(blockHash, 0)
+        for blockHash in reversed(missing):
+            msg = hashlib.sha256()
+            msg.update(self.getBlockFilter(blockHash).getHash().to_bytes(32, "big"))
+            msg.update(prevHeader.to_bytes(32, "big"))
+            prevHeader = int.from_bytes(msg.digest(), "big")
+            self.filterHeaders[blockHash] = prevHeader
+
+        return self.filterHeaders[blkHash]
+
+    def matchFilters(self, items, startHeight=0, stopHeight=None):
+        """ Test items (outpoint tuples, or data values) against the filters of the active chain blocks from
+            startHeight to stopHeight inclusive (default: the tip).
+            Return the blocks that may involve any of the items, lowest first; only their contents need fetching. """
+        snapshot = self.getSnapshot()
+        if stopHeight == None or stopHeight > snapshot.height:
+            stopHeight = snapshot.height
+
+        matches = []
+        for height in range(max(startHeight, 0), stopHeight + 1):
+            block = snapshot.getBlockAtHeight(height)
+            if self.getBlockFilter(block.getHash()).matchAny(items):
+                matches.append(block)
+        return matches
+
+    def verifyInclusion(self, txHash, blockHash, txIdx, proof):
+        """ Return True if proof (from Block.getInclusionProof) shows the transaction with hash txHash at txIdx in
+            the block blockHash, and that block is on the active chain.  Works in headers-only mode, as it only
+            needs the block's merkle root. """
+        snapshot = self.getSnapshot()
+        block = self.blockHashMapping.get(blockHash)
+        if block == None or snapshot.getBlockAtHeight(block.height) is not block:
+            return False
+        return verifyMerkleProof(txHash.to_bytes(32, "big"), txIdx, proof, block.getMerkleRoot())
 
     def displayChain(self):
         print()
@@ -0,0 +1,76 @@
+""" Load test for rpcServer: requests/sec and latency percentiles against a local instance.
+
+    python3 rpcLoadTest.py [numClients] [seconds] [numBlocks]
+
+Builds a chain of numBlocks blocks, serves it on an ephemeral port, and runs numClients keep-alive
+connections that send a mix of getTip, getBlocksAtHeight, getCumulativeWork, batches and unspent output
+lookups for the given number of seconds.
+"""
+import http.client
+import json
+import sys
+import threading
+import time
+
+from blockchain import *
+from rpcServer import BlockchainRpcServer, hexHash
+from benchBlockchain import EASY_TARGET, MakeChainBlocks
+
+
+def Percentile(sortedValues, fraction):
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * fraction))]
+
+
+def LoadTest(numClients=8, seconds=5.0, numBlocks=200):
+    chain = Blockchain(EASY_TARGET, 10**9)
+    blocks = MakeChainBlocks(chain.getTip().getHash(), numBlocks)
+    chain.extendMany(blocks)
+    server = BlockchainRpcServer(chain).start()
+    host, port = server.address
+
+    tipHash = hexHash(chain.getTip().getHash())
+    mint = blocks[-1].getContents()[0]
+    requests = [
+        {"jsonrpc": "2.0", "id": 1, "method": "getTip"},
+        {"jsonrpc": "2.0", "id": 2, "method": "getBlocksAtHeight", "params": [numBlocks // 2]},
+        {"jsonrpc": "2.0", "id": 3, "method": "getCumulativeWork", "params": [tipHash]},
+        [{"jsonrpc": "2.0", "id": i, "method": "getBlocksAtHeight", "params": [i]} for i in range(10)],
+        {"jsonrpc": "2.0", "id": 4, "method": "getUnspentOutput", "params": [hexHash(mint.getHash()), 0]},
+    ]
+    bodies = [json.dumps(r).encode() for r in requests]
+
+    latencies = [[] for i in range(numClients)]
+    stop = time.perf_counter() + seconds
+
+    def client(n):
+        conn = http.client.HTTPConnection(host, port)
+        i = n
+        while time.perf_counter() < stop:
+            body = bodies[i % len(bodies)]
+            start = time.perf_counter()
+            conn.request("POST", "/", body, {"Content-Type": "application/json"})
+            reply = conn.getresponse().read()
+            latencies[n].append(time.perf_counter() - start)
+            assert(b'"error"' not in reply)
+            i += 1
+        conn.close()
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(numClients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    allLatencies = sorted(l for ls in latencies for l in ls)
+    print("%d clients, %d requests in %.1fs: %.0f requests/s, latency p50 %.2fms p99 %.2fms p99.9 %.2fms max %.2fms"
+          % (numClients, len(allLatencies), elapsed, len(allLatencies) / elapsed,
+             Percentile(allLatencies, 0.5) * 1000, Percentile(allLatencies, 0.99) * 1000,
+             Percentile(allLatencies, 0.999) * 1000, allLatencies[-1] * 1000))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    LoadTest(int(args[0]) if len(args) > 0 else 8, float(args[1]) if len(args) > 1 else 5.0, int(args[2]) if len(args) > 2 else 200)
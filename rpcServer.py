@@ -0,0 +1,312 @@
+""" A local JSON-RPC 2.0 server over HTTP for a Blockchain instance.
+
+Start one next to an existing chain:
+
+    server = BlockchainRpcServer(chain, port=8332)
+    server.start()        # serves on a background thread, server.shutdown() stops it
+
+or run "python3 rpcServer.py [port]" for a server over a fresh chain.
+
+POST a JSON-RPC request (or a batch: a list of them) to "/".  Connections are kept alive between requests.
+
+Methods (hashes are 64 digit hex strings):
+    getTip()                              header of the tip block
+    getCumulativeWork(blockHash)          number, or null if the block is unknown
+    getBlocksAtHeight(height)             list of headers
+    getBlock(blockHash)                   header plus transactions
+    extend(block) / submitBlock(block)    true if the block was added
+    getTransaction(txHash)                transaction on the active chain plus the hash of its block
+    getUnspentOutput(txHash, txIdx)       unspent output at the tip, or null once it is spent
+
+A header is {"hash", "version", "parent", "target", "time", "nonce", "height", "cumulativeWork"}.
+A submitted block is the header fields plus "transactions": [{"inputs": [{"txHash", "txIdx", "satisfier"}],
+"outputs": [{"amount", "script"}], "data"}], where "script" is the hex byte code of a Script (or null for no
+constraint); lambdas cannot be sent over the wire.  Satisfier and data values that are bytes are written as
+{"bytes": hex}.
+"""
+import inspect
+import json
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from blockchain import *
+
+
+class RpcError(Exception):
+    """ An error reported to the caller as a JSON-RPC error object """
+    PARSE_ERROR = -32700
+    INVALID_REQUEST = -32600
+    METHOD_NOT_FOUND = -32601
+    INVALID_PARAMS = -32602
+    INTERNAL_ERROR = -32603
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+
+def hexHash(value):
+    return "%064x" % value
+
+
+def parseHash(value):
+    try:
+        return int(value, 16)
+    except (TypeError, ValueError):
+        raise RpcError(RpcError.INVALID_PARAMS, "bad hash %r" % (value,))
+
+
+def parseInt(value):
+    if type(value) in (int, str):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    raise RpcError(RpcError.INVALID_PARAMS, "bad integer %r" % (value,))
+
+
+def encodeValue(value):
+    """ Make a satisfier or data value JSON friendly """
+    if type(value) == bytes:
+        return {"bytes": value.hex()}
+    if type(value) == list:
+        return [encodeValue(v) for v in value]
+    return value
+
+
+def decodeValue(value):
+    if type(value) == dict and "bytes" in value:
+        return bytes.fromhex(value["bytes"])
+    if type(value) == list:
+        return [decodeValue(v) for v in value]
+    return value
+
+
+def headerToJson(block):
+    return {"hash": hexHash(block.getHash()), "version": block.version, "parent": hexHash(block.parentBlockHash),
+            "target": hexHash(block.target), "time": block.time, "nonce": block.nonce,
+            "height": block.height, "cumulativeWork": block.cumulativeWork}
+
+
+def transactionToJson(txn):
+    return {"hash": hexHash(txn.getHash()),
+            "inputs": [{"txHash": hexHash(i.txHash), "txIdx": i.txIdx, "satisfier": encodeValue(i.satisfier)} for i in txn.inputs],
+            "outputs": [outputToJson(o) for o in txn.outputs],
+            "data": encodeValue(txn.data)}
+
+
+def outputToJson(output):
+    """ Scripts are sent as byte code; a lambda can't be, so it only shows up as "lambda": true """
+    if type(output.constraint) == Script:
+        return {"amount": output.amount, "script": output.constraint.serialize().hex()}
+    return {"amount": output.amount, "script": None, "lambda": True}
+
+
+def blockFromJson(obj):
+    """ Build a Block from its JSON form (see the module docstring) """
+    try:
+        b = Block()
+        b.version = int(obj.get("version", 0))
+        b.setPriorBlockHash(parseHash(obj["parent"]))
+        b.setTarget(parseHash(obj["target"]))
+        b.time = int(obj.get("time", 3))
+        b.nonce = int(obj["nonce"])
+        txs = obj.get("transactions")
+        if txs != None:
+            txs = [transactionFromJson(t) for t in txs]
+        b.setContents(txs)
+        return b
+    except RpcError:
+        raise
+    except (KeyError, TypeError, ValueError, AttributeError, AssertionError) as e:
+        raise RpcError(RpcError.INVALID_PARAMS, "bad block: %r" % (e,))
+
+
+def transactionFromJson(obj):
+    inputs = [Input(parseHash(i["txHash"]), int(i["txIdx"]), decodeValue(i.get("satisfier", []))) for i in obj.get("inputs", [])]
+    outputs = []
+    for o in obj.get("outputs", []):
+        script = o.get("script")
+        outputs.append(Output(Script.deserialize(bytes.fromhex(script)) if script != None else None, int(o["amount"])))
+    return Transaction(inputs, outputs, decodeValue(obj.get("data")))
+
+
+class BlockchainRpcServer:
+    """ Serves a Blockchain over JSON-RPC.
+
+        Light calls (tip, work, headers) are answered on the connection's thread from the current
+        snapshot and a cache of already serialized headers.  Heavy calls (block submission and
+        transaction / unspent output lookups) are run on a worker pool of `workers` threads, so a burst
+        of them can't take over every connection thread.
+    """
+    HEAVY_METHODS = ("extend", "submitBlock", "getTransaction", "getUnspentOutput", "getBlock")
+
+    def __init__(self, chain, host="127.0.0.1", port=0, workers=4, maxHeaders=10000):
+        self.chain = chain
+        self.pool = ThreadPoolExecutor(workers)
+        # block hash -> header serialized as JSON text, the maxHeaders most recently used
+        self.headerCache = OrderedDict()
+        self.maxHeaders = maxHeaders
+        self.headerLock = threading.Lock()
+        self.methods = {
+            "getTip": self.getTip,
+            "getCumulativeWork": self.getCumulativeWork,
+            "getBlocksAtHeight": self.getBlocksAtHeight,
+            "getBlock": self.getBlock,
+            "extend": self.submitBlock,
+            "submitBlock": self.submitBlock,
+            "getTransaction": self.getTransaction,
+            "getUnspentOutput": self.getUnspentOutput,
+        }
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keep-alive
+            disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                reply = server.handle(body)
+                self.send_response(200 if reply != None else 204)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(reply or b"")))
+                self.end_headers()
+                if reply != None:
+                    self.wfile.write(reply)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpServer = ThreadingHTTPServer((host, port), Handler)
+        self.httpServer.daemon_threads = True
+        self.address = self.httpServer.server_address
+        self.thread = None
+
+    def start(self):
+        """ Serve on a background thread """
+        self.thread = threading.Thread(target=self.httpServer.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def shutdown(self):
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+        self.pool.shutdown()
+
+    def handle(self, body):
+        """ Answer a request body, return the response body (None if there is nothing to send back) """
+        try:
+            request = json.loads(body)
+        except ValueError:
+            return self.errorJson(None, RpcError(RpcError.PARSE_ERROR, "parse error")).encode()
+
+        if type(request) == list:
+            if not request:
+                return self.errorJson(None, RpcError(RpcError.INVALID_REQUEST, "empty batch")).encode()
+            replies = [r for r in (self.call(item) for item in request) if r != None]
+            return ("[" + ",".join(replies) + "]").encode() if replies else None
+
+        reply = self.call(request)
+        return reply.encode() if reply != None else None
+
+    def call(self, request):
+        """ Run one JSON-RPC call and return its response as JSON text (None for a notification) """
+        if type(request) != dict or type(request.get("method")) != str:
+            return self.errorJson(None, RpcError(RpcError.INVALID_REQUEST, "invalid request"))
+        requestId = request.get("id")
+        try:
+            method = self.methods.get(request["method"])
+            if method == None:
+                raise RpcError(RpcError.METHOD_NOT_FOUND, "method not found: %s" % request["method"])
+            params = request.get("params", [])
+            # check the params against the handler up front, so a TypeError from inside it is an internal error
+            try:
+                if type(params) == dict:
+                    bound = inspect.signature(method).bind(**params)
+                elif type(params) == list:
+                    bound = inspect.signature(method).bind(*params)
+                else:
+                    raise TypeError("params must be a list or an object")
+            except TypeError as e:
+                raise RpcError(RpcError.INVALID_PARAMS, str(e))
+            run = lambda: method(*bound.args, **bound.kwargs)
+
+            if request["method"] in self.HEAVY_METHODS:
+                result = self.pool.submit(run).result()
+            else:
+                result = run()
+        except RpcError as e:
+            return self.errorJson(requestId, e)
+        except Exception as e:
+            return self.errorJson(requestId, RpcError(RpcError.INTERNAL_ERROR, repr(e)))
+
+        if "id" not in request:
+            return None
+        return '{"jsonrpc":"2.0","id":%s,"result":%s}' % (json.dumps(requestId), result)
+
+    def errorJson(self, requestId, error):
+        return json.dumps({"jsonrpc": "2.0", "id": requestId, "error": {"code": error.code, "message": error.message}})
+
+    def headerJson(self, block):
+        """ Return the header of block as JSON text; headers never change once connected, so they are cached
+            (headers of blocks collectStaleForks dropped simply age out) """
+        blockHash = block.getHash()
+        with self.headerLock:
+            text = self.headerCache.get(blockHash)
+            if text != None:
+                self.headerCache.move_to_end(blockHash)
+                return text
+        text = json.dumps(headerToJson(block))
+        with self.headerLock:
+            self.headerCache[blockHash] = text
+            while len(self.headerCache) > self.maxHeaders:
+                self.headerCache.popitem(last=False)
+        return text
+
+    # The methods return their result already serialized as JSON text
+
+    def getTip(self):
+        return self.headerJson(self.chain.getSnapshot().getTip())
+
+    def getCumulativeWork(self, blockHash):
+        return json.dumps(self.chain.getCumulativeWork(parseHash(blockHash)))
+
+    def getBlocksAtHeight(self, height):
+        return "[" + ",".join(self.headerJson(b) for b in self.chain.getBlocksAtHeight(parseInt(height))) + "]"
+
+    def getBlock(self, blockHash):
+        # .get, not [], on the chain's defaultdict: a lookup must never insert a blank Block into its index
+        block = self.chain.blockHashMapping.get(parseHash(blockHash))
+        if block == None:
+            return "null"
+        txs = block.getContents()
+        txs = [transactionToJson(t) for t in txs] if hasTransactions(txs) else None
+        return '{"header":%s,"transactions":%s}' % (self.headerJson(block), json.dumps(txs))
+
+    def submitBlock(self, block):
+        return json.dumps(self.chain.extend(blockFromJson(block)))
+
+    def getTransaction(self, txHash):
+        txHash = parseHash(txHash)
+        snapshot = self.chain.getSnapshot()
+        for block, txn in self.chain.iterTransactions(snapshot.height, -1):
+            if txn.getHash() == txHash:
+                return json.dumps({"block": hexHash(block.getHash()), "transaction": transactionToJson(txn)})
+        return "null"
+
+    def getUnspentOutput(self, txHash, txIdx):
+        # null once the output is spent (Blockchain.getUnspentOutput reads the snapshot, without locking)
+        output = self.chain.getUnspentOutput(parseHash(txHash), parseInt(txIdx))
+        return json.dumps(outputToJson(output) if output != None else None)
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8332
+    server = BlockchainRpcServer(Blockchain(int("4" + ("F"*63),16), 50), port=port)
+    print("serving JSON-RPC on http://%s:%d/" % server.address)
+    server.httpServer.serve_forever()
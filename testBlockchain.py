@@ -233,12 +233,1050 @@ def TestBlockchainWithTransactions():
     
     
     
+def TestExtendMany():
+    tgt = int("1" + ("F"*63),16)
+
+    # build the same blocks for two chains: one fed block by block, the other in one shuffled batch
+    chain = Blockchain(int("4" + ("F"*63),16), 50)
+    blocks = []
+    parent = chain.getTip().getHash()
+    for i in range(6):
+        tx = Transaction(None, [Output(lambda x: True, 50)])
+        b = Block()
+        b.setPriorBlockHash(parent)
+        b.setContents([tx])
+        b.mine(tgt)
+        blocks.append(b)
+        parent = b.getHash()
+    # a heavier fork off the second block, and a block that mints too much
+    fork = Block()
+    fork.setPriorBlockHash(blocks[1].getHash())
+    fork.setContents(None)
+    fork.mine(int(tgt/64))
+    bad = Block()
+    bad.time = 4  # not the same header as blocks[3]
+    bad.setPriorBlockHash(blocks[2].getHash())
+    bad.setContents([Transaction(None, [Output(lambda x: True, 60)])])
+    bad.mine(tgt)
+    orphan = Block()
+    orphan.setPriorBlockHash(1234)
+    orphan.mine(tgt)
+
+    batch = [blocks[3], orphan, blocks[0], bad, blocks[5], fork, blocks[2], blocks[1], blocks[4]]
+    results = chain.extendMany(iter(batch))
+    assert(results == [True, False, True, False, True, True, True, True, True])
+    assert(chain.getTip() == fork)
+    assert(len(chain.getBlocksAtHeight(6)) == 1)
+
+    sequential = Blockchain(int("4" + ("F"*63),16), 50)
+    for b in blocks + [fork]:
+        sequential.extend(b)
+    assert(sequential.getTip().getHash() == chain.getTip().getHash())
+
+    # orphans beyond the limit are dropped
+    chain = Blockchain(int("4" + ("F"*63),16), 50)
+    results = chain.extendMany([blocks[2], blocks[1], blocks[0]], maxOrphans=1)
+    assert(results == [False, True, True])
+    assert(chain.getTip() == blocks[1])
+
+def TestStagedValidation():
+    chain = Blockchain(int("4" + ("F"*63),16), 50)
+    tgt = int("1" + ("F"*63),16)
+
+    # count unspent output rebuilds, cheap rejections must not need one
+    rebuilds = []
+    findUnspentOutputs = chain.findUnspentOutputs
+    chain.findUnspentOutputs = lambda blk: rebuilds.append(blk) or findUnspentOutputs(blk)
+
+    tx0 = Transaction(None, [Output(lambda x: x[0] == "alice", 50)])
+    g = MineBlock(chain, chain.getTip().getHash(), tgt, [ tx0 ])
+    assert(g != None)
+
+    # hash does not meet the target
+    b = Block()
+    b.setPriorBlockHash(g.getHash())
+    b.setContents([ Transaction(None, [Output(lambda x: True, 50)]) ])
+    b.setTarget(1)
+    assert(not chain.extend(b))
+
+    # a target of 0 can never be met
+    b.setTarget(0)
+    assert(not chain.extend(b))
+
+    # the same output spent twice in one block
+    b = MineBlock(chain, g.getHash(), tgt, [ Transaction(None, [Output(lambda x: True, 50)]),
+        Transaction([Input(tx0.getHash(),0,["alice"])], [Output(lambda x: True, 50)]),
+        Transaction([Input(tx0.getHash(),0,["alice"])], [Output(lambda x: True, 50)]) ])
+    assert(b == None)
+    assert(chain.getRejectionCounts()["pow"] == 2)
+    assert(chain.getRejectionCounts()["structure"] == 1)
+    assert(len(rebuilds) == 1)
+
+    # too much minted is caught before the rebuild too
+    b = MineBlock(chain, g.getHash(), tgt, [ Transaction(None, [Output(lambda x: True, 30), Output(lambda x: True, 30)]) ])
+    assert(b == None)
+    assert(len(rebuilds) == 1)
+
+    # spending more than the input
+    b = MineBlock(chain, g.getHash(), tgt, [ Transaction(None, [Output(lambda x: True, 50)]), Transaction([Input(tx0.getHash(),0,["alice"])], [Output(lambda x: True, 51)]) ])
+    assert(b == None)
+    assert(chain.getRejectionCounts()["amounts"] == 2)
+
+    # constraint returns False, or throws
+    b = MineBlock(chain, g.getHash(), tgt, [ Transaction(None, [Output(lambda x: True, 50)]), Transaction([Input(tx0.getHash(),0,["bob"])], [Output(lambda x: True, 50)]) ])
+    assert(b == None)
+    b = MineBlock(chain, g.getHash(), tgt, [ Transaction(None, [Output(lambda x: True, 50)]), Transaction([Input(tx0.getHash(),0,[None, 1])], [Output(lambda x: True, 50)]) ])
+    assert(b == None)
+    assert(chain.getRejectionCounts()["scripts"] == 2)
+
+    # a block with an empty transaction list is valid
+    b = MineBlock(chain, g.getHash(), tgt, [])
+    assert(b != None)
+    assert(chain.getTip() == b)
+
+    assert(MineBlock(chain, 1234, tgt) == None)
+    assert(chain.getRejectionCounts() == {"orphan": 1, "pow": 2, "structure": 1, "amounts": 2, "scripts": 2})
+
+def TestBlockFilters():
+    chain = Blockchain(int("4" + ("F"*63),16), 50)
+    tgt = int("1" + ("F"*63),16)
+
+    tx0 = Transaction(None, [Output(lambda x: True, 50)])
+    b1 = MineBlock(chain, chain.getTip().getHash(), tgt, [ tx0 ])
+    tx1 = Transaction(None, [Output(lambda x: True, 40)], "memo")
+    tx2 = Transaction([Input(tx0.getHash(),0,[])], [Output(lambda x: True, 20), Output(lambda x: True, 30)])
+    b2 = MineBlock(chain, b1.getHash(), tgt, [ tx1, tx2 ])
+    b3 = MineBlock(chain, b2.getHash(), tgt, [ Transaction(None, [Output(lambda x: True, 1)]) ])
+
+    f2 = chain.getBlockFilter(b2.getHash())
+    assert(f2.match((tx2.getHash(), 1)))     # created
+    assert(f2.match((tx0.getHash(), 0)))     # spent
+    assert(f2.match("memo"))
+    assert(not f2.match((tx2.getHash(), 7)))
+    assert(not chain.getBlockFilter(chain.root.getHash()).match((tx0.getHash(), 0)))
+    assert(chain.getBlockFilter(1234) == None)
+
+    # a decoded copy of the filter matches the same way
+    copy2 = BlockFilter(b2.getHash(), f2.encoded)
+    assert(list(copy2.values()) == list(f2.values()))
+    assert(copy2.matchAny([(1, 1), "memo"]))
+
+    # tx0's output is created in b1 and spent in b2
+    assert(chain.matchFilters([(tx0.getHash(), 0)]) == [b1, b2])
+    assert(chain.matchFilters([(tx0.getHash(), 0)], 2) == [b2])
+    assert(chain.matchFilters([(tx0.getHash(), 0)], 0, 1) == [b1])
+    assert(chain.matchFilters([(12345, 0)]) == [])
+
+    # filter headers chain like block hashes
+    h3 = chain.getFilterHeader(b3.getHash())
+    h2 = chain.getFilterHeader(b2.getHash())
+    expected = int.from_bytes(hashlib.sha256(chain.getBlockFilter(b3.getHash()).getHash().to_bytes(32,"big") + h2.to_bytes(32,"big")).digest(), "big")
+    assert(h3 == expected)
+    assert(chain.getFilterHeader(chain.root.getHash()) == int.from_bytes(hashlib.sha256(chain.getBlockFilter(chain.root.getHash()).getHash().to_bytes(32,"big") + bytes(32)).digest(), "big"))
+
+    # items whose hashed values collide are all still matched, also from the decoded filter
+    class TinyFilter(BlockFilter):
+        FILTER_M = 1   # n items hashed into [0, n), so some collide
+    b = Block()
+    b.setContents([ Transaction(None, [], "item %d" % i) for i in range(20) ])
+    flt = TinyFilter.build(b, 99)
+    assert(flt.n == 20 and len(set(flt.values())) < 20)
+    for f in (flt, TinyFilter(99, flt.encoded)):
+        assert(all(f.match("item %d" % i) for i in range(20)))
+
+    # data values that aren't bytes or strings get a canonical encoding instead of bytes()
+    b = Block()
+    b.setContents([ Transaction(None, [], ["a", "b"]), Transaction(None, [], 10**12), Transaction(None, [], {"y": 1, "x": [2]}) ])
+    flt = BlockFilter.build(b, 99)
+    assert(len(BlockFilter.itemBytes(10**12)) < 20)
+    assert(flt.match(["a", "b"]) and flt.match(10**12) and flt.match({"x": [2], "y": 1}))
+    assert(not flt.match(["b", "a"]))
+
+def TestConcurrentReaders():
+    chain = Blockchain(int("4" + ("F"*63),16), 50)
+    tgt = int("1" + ("F"*63),16)
+    errors = []
+    done = threading.Event()
+
+    def writer():
+        try:
+            parent = chain.getTip()
+            for i in range(60):
+                tx = Transaction(None, [Output(lambda x: True, i % 50)])
+                b = MineBlock(chain, parent.getHash(), tgt, [ tx ])
+                # every few blocks a heavier sibling reorgs the tip away from b
+                if i % 5 == 4:
+                    b = MineBlock(chain, parent.getHash(), int(tgt/4), [ Transaction(None, [Output(lambda x: True, 50)]) ])
+                parent = b
+        except Exception as e:
+            errors.append(e)
+        finally:
+            done.set()
+
+    def reader():
+        try:
+            while not done.is_set():
+                snap = chain.getSnapshot()
+                assert(snap.getBlockAtHeight(snap.height) is snap.tip)
+                assert(snap.getBlockAtHeight(snap.height + 1) == None)
+                for h in range(snap.height, 0, -1):
+                    assert(snap.getBlockAtHeight(h).getPriorBlockHash() == snap.getBlockAtHeight(h-1).getHash())
+                utxo = snap.getUnspentOutputs()
+                for tx in snap.tip.getContents() if snap.height > 0 else []:
+                    assert((tx.getHash(), 0) in utxo)
+                chain.getBlocksAtHeight(snap.height)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=reader) for i in range(4)] + [threading.Thread(target=writer)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert(errors == [])
+
+    snap = chain.getSnapshot()
+    assert(snap.tip == chain.getTip())
+    assert(snap.height == 60)
+    assert(snap.getBlockAtHeight(5).target == int(tgt/4))
+
+    # an old snapshot keeps its view across a reorg
+    tip = chain.getTip()
+    MineBlock(chain, tip.getHash(), tgt)
+    old = chain.getSnapshot()
+    b = MineBlock(chain, tip.getHash(), int(tgt/4))
+    assert(old.getBlockAtHeight(61) != b)
+    assert(chain.getSnapshot().getBlockAtHeight(61) == b)
+
+def TestAssumeValid():
+    tgt = int("1" + ("F"*63),16)
+    genesis = Blockchain(int("4" + ("F"*63),16), 50).getTip().getHash()
+
+    times = iter(range(10, 100))
+
+    def mined(parent, txs):
+        b = Block()
+        b.time = next(times)  # block hashes don't cover the contents, keep the headers distinct
+        b.setPriorBlockHash(parent)
+        b.setContents(txs)
+        b.mine(tgt)
+        return b
+
+    # b2 spends with a satisfier its constraint rejects, so only assume-valid lets it in
+    tx0 = Transaction(None, [Output(lambda x: x[0] == "alice", 40), Output(lambda x: x[0] == "alice", 10)])
+    b1 = mined(genesis, [ tx0 ])
+    b2 = mined(b1.getHash(), [ Transaction(None, [Output(lambda x: True, 1)]), Transaction([Input(tx0.getHash(),0,["mallory"])], [Output(lambda x: True, 40)]) ])
+    b3 = mined(b2.getHash(), [ Transaction(None, [Output(lambda x: True, 2)]) ])
+    # above the trusted block, and on a fork without it, scripts run again
+    above = mined(b3.getHash(), [ Transaction(None, [Output(lambda x: True, 3)]), Transaction([Input(tx0.getHash(),1,["mallory"])], [Output(lambda x: True, 10)]) ])
+    fork = mined(b1.getHash(), [ Transaction(None, [Output(lambda x: True, 4)]), Transaction([Input(tx0.getHash(),1,["mallory"])], [Output(lambda x: True, 10)]) ])
+    unrelated = mined(1234, [])
+
+    chain = Blockchain(int("4" + ("F"*63),16), 50)
+    assert(chain.extendMany([b1, b2, b3]) == [True, False, False])
+
+    chain = Blockchain(int("4" + ("F"*63),16), 50, assumeValid=b3.getHash())
+    assert(chain.loadAssumeValidHeaders([above, b3, b2, b1, fork, unrelated]) == 3)
+    assert(chain.isAssumedValid(b2.getHash()))
+    assert(not chain.isAssumedValid(fork.getHash()))
+    assert(chain.extendMany([b1, b2, b3, above, fork]) == [True, True, True, False, False])
+    assert(chain.getTip() == b3)
+    assert(chain.assumedValidCount == 3)
+    assert(chain.getRejectionCounts()["scripts"] == 2)
+
+    # the trusted header with other transactions is not trusted: its scripts run
+    swapped = Block()
+    swapped.time = b2.time
+    swapped.setPriorBlockHash(b2.getPriorBlockHash())
+    swapped.setContents([ Transaction(None, [Output(lambda x: True, 1)]), Transaction([Input(tx0.getHash(),1,["mallory"])], [Output(lambda x: True, 10)]) ])
+    swapped.mine(tgt)
+    swapped.nonce = b2.nonce
+    assert(swapped.getHash() == b2.getHash() and swapped.getMerkleRoot() != b2.getMerkleRoot())
+    chain = Blockchain(int("4" + ("F"*63),16), 50, assumeValid=b3.getHash())
+    chain.loadAssumeValidHeaders([b3, b2, b1])
+    assert(chain.isAssumedValid(b2.getHash()) and not chain.isAssumedValid(b2.getHash(), swapped.getMerkleRoot()))
+    assert(chain.extendMany([b1, swapped]) == [True, False])
+    assert(chain.getRejectionCounts()["scripts"] == 1 and chain.assumedValidCount == 1)
+
+    # Block.validate can skip the scripts too, but not the other checks
+    utxo = MakeUtxoFrom(tx0)
+    assert(not b2.validate(utxo, 50))
+    assert(b2.validate(utxo, 50, skipScripts=True))
+    assert(not b2.validate({}, 50, skipScripts=True))
+
+def TestLazyContents():
+    import tempfile
+    tgt = int("1" + ("F"*63),16)
+
+    for store in [MemoryContentStore(), DiskContentStore(tempfile.mkdtemp())]:
+        # small enough that only a couple of blocks fit
+        cache = ContentCache(store, maxBytes=1500)
+        chain = Blockchain(int("4" + ("F"*63),16), 50, contentCache=cache)
+
+        prev = Transaction(None, [Output(lambda x: x[0] == "alice", 50)])
+        b = MineBlock(chain, chain.getTip().getHash(), tgt, [ prev ])
+        blocks = [b]
+        for i in range(8):
+            tx = Transaction([Input(prev.getHash(),0,["alice"])], [Output(lambda x: x[0] == "alice", 49 - i)])
+            b = MineBlock(chain, b.getHash(), tgt, [ Transaction(None, [Output(lambda x: True, i)]), tx ])
+            assert(b != None)
+            blocks.append(b)
+            prev = tx
+
+        assert(type(blocks[0].blockContents) == LazyBlockContents)
+        stats = cache.getStats()
+        assert(stats["evictions"] > 0 and stats["bytes"] <= 1500)
+
+        # the contents come back from the store, and still validate spends
+        assert(blocks[0].getContents()[0].getHash() == blocks[0].getContents()[0].getHash())
+        assert(cache.getStats()["misses"] > stats["misses"])
+        assert(cache.getStats()["hits"] > stats["hits"])
+        tx = Transaction([Input(prev.getHash(),0,["bob"])], [Output(lambda x: True, 1)])
+        assert(MineBlock(chain, b.getHash(), tgt, [ Transaction(None, [Output(lambda x: True, 50)]), tx ]) == None)
+        tx = Transaction([Input(prev.getHash(),0,["alice"])], [Output(lambda x: True, 1)])
+        assert(MineBlock(chain, b.getHash(), tgt, [ Transaction(None, [Output(lambda x: True, 20)]), tx ]) != None)
+        assert(len(chain.getSnapshot().getUnspentOutputs()) == 10)   # 19 created, 9 spent
+
+def TestUtxoTable():
+    t0 = Transaction(None, [Output(lambda x: True, 30), Output(lambda x: x[0] == "alice", 20)])
+    table = UtxoTable(MakeUtxoFrom(t0))
+    assert(len(table) == 2)
+    assert((t0.getHash(), 1) in table and (t0.getHash(), 2) not in table)
+    assert(table[(t0.getHash(), 1)].amount == 20)
+
+    # works as the unspent output dictionary of Transaction.validate
+    t1 = Transaction([Input(t0.getHash(), 1, ["alice"])], [Output(lambda x: True, 20)])
+    assert(t1.validate(table))
+    t1 = Transaction([Input(t0.getHash(), 1, ["bob"])], [Output(lambda x: True, 20)])
+    assert(not t1.validate(table))
+
+    # same behaviour as a dict through inserts, overwrites, deletes and resizes
+    ref = {}
+    table = UtxoTable()
+    rng = random.Random(7)
+    for i in range(3000):
+        key = (rng.getrandbits(256), rng.randrange(4))
+        if ref and rng.random() < 0.3:
+            key = rng.choice(list(ref))
+            del ref[key]
+            del table[key]
+        else:
+            ref[key] = Output(None, i)
+            table[key] = ref[key]
+    assert(len(table) == len(ref))
+    assert(set(table) == set(ref))
+    for key, out in ref.items():
+        assert(table[key].amount == out.amount)
+    assert(table.get((1, 1)) == None)
+
+    # amounts past 64 bits are kept exactly, through overwrites, resizes and deletes
+    table = UtxoTable()
+    table[(1, 0)] = Output(None, 2**63)
+    table[(2, 0)] = Output(None, -2**63)
+    for i in range(3, 40):
+        table[(i, 0)] = Output(None, i)
+    assert(table[(1, 0)].amount == 2**63 and table.get((2, 0)).amount == -2**63 and table[(39, 0)].amount == 39)
+    table[(1, 0)] = Output(None, 5)
+    assert(table[(1, 0)].amount == 5 and len(table.bigAmounts) == 1)
+    del table[(2, 0)]
+    assert((2, 0) not in table and table.bigAmounts == {})
+    # a key that can't be stored leaves the table untouched
+    refs = list(table.constraintRefs)
+    try:
+        table[(3, 2**40)] = Output(None, 2**70)
+        assert(False)
+    except OverflowError:
+        pass
+    assert(table.constraintRefs == refs and len(table) == 38 and table.bigAmounts == {})
+
+    # outputs made by the same lambda expression share one constraint table entry
+    for i in range(10):
+        table[(i, 0)] = Output(lambda x: x[0] == "alice", 1)
+    assert(len([c for c in table.constraints if c != None]) == 2)
+
+    # a chain can build its unspent outputs in a table
+    chain = Blockchain(int("4" + ("F"*63),16), 50, unspentOutputType=UtxoTable)
+    tgt = int("1" + ("F"*63),16)
+    tx0 = Transaction(None, [Output(lambda x: x[0] == "alice", 50)])
+    g = MineBlock(chain, chain.getTip().getHash(), tgt, [ tx0 ])
+    assert(type(chain.findUnspentOutputs(g)) == UtxoTable)
+    assert(MineBlock(chain, g.getHash(), tgt, [ Transaction(None, [Output(lambda x: True, 1)]), Transaction([Input(tx0.getHash(),0,["bob"])], [Output(lambda x: True, 50)]) ]) == None)
+    # a mint of 2**63 coins can be spent, as with a dict
+    big = Blockchain(int("4" + ("F"*63),16), 2**64, unspentOutputType=UtxoTable)
+    txBig = Transaction(None, [Output(None, 2**63)])
+    gBig = MineBlock(big, big.getTip().getHash(), tgt, [ txBig ])
+    assert(MineBlock(big, gBig.getHash(), tgt, [ Transaction(None, [Output(None, 1)]), Transaction([Input(txBig.getHash(),0,[])], [Output(None, 2**63)]) ]) != None)
+
+    # an input index too big for a table key is just a missing output, as with a dict
+    big = (tx0.getHash(), 2**40)
+    assert(big not in table and table.get(big) == None)
+    assert(MineBlock(chain, g.getHash(), tgt, [ Transaction(None, [Output(lambda x: True, 1)]), Transaction([Input(*big, ["alice"])], [Output(lambda x: True, 50)]) ]) == None)
+    assert(chain.getRejectionCounts()["amounts"] == 1)
+    assert(MineBlock(chain, g.getHash(), tgt, [ Transaction(None, [Output(lambda x: True, 1)]), Transaction([Input(tx0.getHash(),0,["alice"])], [Output(lambda x: True, 50)]) ]) != None)
+
+def TestChainEvents():
+    chain = Blockchain(int("4" + ("F"*63),16), 50)
+    tgt = int("1" + ("F"*63),16)
+    received = []
+    callbackSub = chain.subscribe(received.append)
+    sub = chain.subscribe()
+    slow = chain.subscribe(maxQueue=2)
+
+    genesis = chain.getTip()
+    a1 = MineBlock(chain, genesis.getHash(), tgt)
+    a2 = MineBlock(chain, a1.getHash(), tgt)
+    b1 = MineBlock(chain, genesis.getHash(), tgt*2)   # less work, tip does not move
+    b2 = MineBlock(chain, b1.getHash(), int(tgt/4))   # reorg from a2 to b2
+
+    events = [sub.get(timeout=1) for i in range(8)]
+    assert([(e.kind, e.block) for e in events] == [
+        ("blockConnected", a1), ("tipChanged", a1),
+        ("blockConnected", a2), ("tipChanged", a2),
+        ("blockDisconnected", a2), ("blockDisconnected", a1), ("blockConnected", b1), ("blockConnected", b2)])
+    tipChanged = sub.get(timeout=1)
+    assert(tipChanged.kind == "tipChanged" and tipChanged.block == b2 and tipChanged.oldTip == a2)
+    assert(tipChanged.disconnected == (a2, a1) and tipChanged.connected == (b1, b2))
+
+    # the slow consumer kept the first events and lost the rest, the chain went on regardless
+    assert(slow.lagging and slow.dropped == 7)
+    assert(slow.get(timeout=1).block == a1)
+
+    callbackSub.close()
+    assert([e.kind for e in received].count("tipChanged") == 3)
+
+    async def consume():
+        seen = []
+        async for event in sub:
+            seen.append(event.kind)
+        return seen
+    MineBlock(chain, b2.getHash(), tgt)
+    sub.close()
+    assert(asyncio.run(consume()) == ["blockConnected", "tipChanged"])
+
+    # an async consumer can be cancelled while it waits, without losing events or stalling asyncio.run
+    sub2 = chain.subscribe()
+    async def cancelled():
+        try:
+            await asyncio.wait_for(sub2.__anext__(), 0.2)
+            assert(False)
+        except asyncio.TimeoutError:
+            pass
+        MineBlock(chain, chain.getTip().getHash(), tgt)
+        event = await asyncio.wait_for(sub2.__anext__(), 1)
+        # woken from another thread too
+        threading.Timer(0.05, sub2.close).start()
+        return [event.kind] + [e.kind async for e in sub2]
+    assert(asyncio.run(cancelled()) == ["blockConnected", "tipChanged"])
+    # closed subscriptions get nothing more
+    MineBlock(chain, chain.getTip().getHash(), tgt)
+    assert(sub.queue.empty())
+
+def TestChainIterators():
+    chain = Blockchain(int("4" + ("F"*63),16), 50)
+    tgt = int("1" + ("F"*63),16)
+    genesis = chain.getTip()
+    main = []
+    parent = genesis
+    for i in range(5):
+        parent = MineBlock(chain, parent.getHash(), tgt, [ Transaction(None, [Output(lambda x: True, i)]) ])
+        main.append(parent)
+    side1 = MineBlock(chain, main[1].getHash(), tgt*2, [ Transaction(None, [Output(lambda x: True, 10)]) ])
+    side2 = MineBlock(chain, side1.getHash(), tgt*2, [])
+
+    assert(list(chain.iterActiveChain()) == [genesis] + main)
+    assert(list(chain.iterActiveChain(2, 4)) == main[1:3])
+    assert(list(chain.iterActiveChain(5, -1)) == list(reversed([genesis] + main)))
+    assert(list(chain.iterActiveChain(100, 3)) == [main[4], main[3]])
+    assert(list(chain.iterActiveChain(3, 100)) == main[2:])
+    assert(list(chain.iterAncestors(side2)) == [side1, main[1], main[0], genesis])
+    assert(list(chain.iterAncestors(genesis)) == [])
+    assert(set(chain.iterDescendants(main[0])) == set(main[1:] + [side1, side2]))
+    assert(list(chain.iterDescendants(side2)) == [])
+    assert([tx.outputs[0].amount for block, tx in chain.iterTransactions(2)] == [1, 2, 3, 4])
+    assert([block for block, tx in chain.iterTransactions(3, 1)] == [main[2], main[1]])
+
+    # unspent outputs of a side branch: active chain up to the fork, then the branch
+    unspent = chain.findUnspentOutputs(side2)
+    assert(sorted(out.amount for out in unspent.values()) == [0, 1, 10])
+
+def TestHash32():
+    tx = Transaction([Input(5, 1, [])], [Output(None, 3)])
+    h = tx.getHashBytes()
+    assert(type(h) == Hash32 and len(h) == 32)
+    assert(int(h) == tx.getHash() and Hash32.fromInt(tx.getHash()) == h)
+    assert(h.meetsTarget(int(h)) and not h.meetsTarget(int(h) - 1) and h.meetsTarget(2**300))
+    assert(ZERO_HASH.meetsTarget(0))
+
+    b = Block()
+    b.mine(int("F"*62,16))
+    assert(int(b.getHashBytes()) == b.getHash() <= int("F"*62,16))
+
+    txs = [Transaction(None, [Output(None, i)]) for i in range(5)]
+    tree = HashableMerkleTree(txs)
+    assert(int(tree.calcMerkleRootBytes()) == tree.calcMerkleRoot())
+    assert(HashableMerkleTree().calcMerkleRootBytes() == ZERO_HASH)
+
+    # Hash32 and int transaction hashes name the same table entry
+    table = UtxoTable()
+    table[(h, 0)] = Output(None, 7)
+    assert(table[(tx.getHash(), 0)].amount == 7)
+    assert(list(table) == [(tx.getHash(), 0)])
+
+def TestScripts():
+    alice = Script("ARG 0 PUSH alice EQUAL")
+    assert(alice(["alice"]) and not alice(["bob"]) and not alice([]))
+    hundred = Script("ARG 0 ARG 1 ADD PUSH 100 EQUAL")
+    assert(hundred([40, 60]) and not hundred([40, 61]) and not hundred(["a", "b"]))
+    preimage = Script("ARG 0 SHA256 PUSH 0x172aea8425ac5db48bb2363e13a7443f5aa5e1e0cad30d943398ff18d5f904f2 EQUAL")
+    assert(preimage([b"preimage secret 1"]) and not preimage([b"bad secret"]) and not preimage(["preimage secret 1"]))
+    assert(not Script("FALSE")([]) and Script("TRUE")([]))
+    assert(Script("ARG 0 PUSH 'two words' EQUAL VERIFY TRUE")(["two words"]))
+    assert(not Script("PUSH 1 VERIFY TRUE")([]))
+    assert(not Script("EQUAL")([]))   # stack underflow
+    assert(Script("PUSH -5 PUSH 5 ADD PUSH 0 EQUAL")([]))
+
+    # byte code round trip, and equal scripts share the compiled program
+    copy = Script.deserialize(hundred.serialize())
+    assert(copy == hundred and copy.program is hundred.program and copy([50, 50]))
+
+    # malformed byte code is refused, truncated constants included
+    for code in (b"\x00", b"\x01\x00", b"\x01\x00\x00\x05ab", b"\x01\x07\x00\x00", b"\x09"):
+        try:
+            Script(code=code)
+            assert(False)
+        except ValueError:
+            pass
+
+    # the compiled program cache keeps the most recently used scripts only
+    maxCached = Script.MAX_CACHED
+    Script.MAX_CACHED = 3
+    try:
+        for i in range(10):
+            Script("PUSH %d" % i)
+        Script(code=hundred.code)
+        assert(len(Script.programCache) == 3 and hundred.code in Script.programCache)
+    finally:
+        Script.MAX_CACHED = maxCached
+
+    # step budget
+    long = Script("TRUE " * 300)
+    assert(not long([]) and long.run([], maxSteps=1000))
+
+    # scripts change the transaction hash, lambdas do not
+    assert(Transaction(None, [Output(alice, 5)]).getHash() != Transaction(None, [Output(hundred, 5)]).getHash())
+    assert(Transaction(None, [Output(lambda x: True, 5)]).getHash() == Transaction(None, [Output(lambda x: False, 5)]).getHash())
+    # a script can't be extended to look like the outputs after it
+    forged = Script(code=alice.code + (5).to_bytes(32, "big"))
+    assert(Transaction(None, [Output(alice, 10), Output(None, 5)]).getHash() != Transaction(None, [Output(forged, 10)]).getHash())
+    assert(Transaction(None, [Output(alice, 10)]).getHash() != Transaction(None, [Output(None, 10)]).getHash())
+
+    # scripts and lambdas in the same chain
+    chain = Blockchain(int("4" + ("F"*63),16), 50)
+    tgt = int("1" + ("F"*63),16)
+    tx0 = Transaction(None, [Output(alice, 30), Output(lambda x: x[0] == "bob", 20)])
+    g = MineBlock(chain, chain.getTip().getHash(), tgt, [ tx0 ])
+    tx1 = Transaction([Input(tx0.getHash(),0,["alice"]), Input(tx0.getHash(),1,["bob"])], [Output(preimage, 50)])
+    assert(MineBlock(chain, g.getHash(), tgt, [ Transaction(None, [Output(None, 1)]), Transaction([Input(tx0.getHash(),0,["bob"])], [Output(None, 30)]) ]) == None)
+    b = MineBlock(chain, g.getHash(), tgt, [ Transaction(None, [Output(None, 1)]), tx1 ])
+    assert(b != None)
+    assert(MineBlock(chain, b.getHash(), tgt, [ Transaction(None, [Output(None, 2)]), Transaction([Input(tx1.getHash(),0,[b"preimage secret 1"])], [Output(None, 50)]) ]) != None)
+
+def TestRpcServer():
+    import http.client
+    import json
+    from rpcServer import BlockchainRpcServer, hexHash
+
+    chain = Blockchain(int("4" + ("F"*63),16), 50)
+    tgt = int("1" + ("F"*63),16)
+    alice = Script("ARG 0 PUSH alice EQUAL")
+    tx0 = Transaction(None, [Output(alice, 50)])
+    g = MineBlock(chain, chain.getTip().getHash(), tgt, [ tx0 ])
+    server = BlockchainRpcServer(chain).start()
+    conn = http.client.HTTPConnection(*server.address)
+
+    def rpc(payload):
+        conn.request("POST", "/", json.dumps(payload))
+        reply = conn.getresponse().read()
+        return json.loads(reply) if reply else None
+
+    try:
+        tip = rpc({"jsonrpc": "2.0", "id": 1, "method": "getTip"})["result"]
+        assert(tip["hash"] == hexHash(g.getHash()) and tip["height"] == 1)
+        batch = rpc([{"jsonrpc": "2.0", "id": 2, "method": "getCumulativeWork", "params": [hexHash(g.getHash())]},
+                     {"jsonrpc": "2.0", "id": 3, "method": "getBlocksAtHeight", "params": {"height": 0}},
+                     {"jsonrpc": "2.0", "method": "getTip"},
+                     {"jsonrpc": "2.0", "id": 4, "method": "noSuchMethod"}])
+        assert(len(batch) == 3)
+        assert(batch[0]["result"] == chain.getCumulativeWork(g.getHash()))
+        assert(batch[1]["result"][0]["hash"] == hexHash(chain.root.getHash()))
+        assert(batch[2]["error"]["code"] == -32601)
+        assert(rpc("not json")["error"]["code"] == -32600)
+
+        # submit a block that spends the script output
+        b = Block()
+        b.setPriorBlockHash(g.getHash())
+        b.mine(tgt)
+        block = {"parent": hexHash(g.getHash()), "target": hexHash(tgt), "time": b.time, "nonce": b.nonce, "transactions": [
+            {"inputs": [], "outputs": [{"amount": 1, "script": None}]},
+            {"inputs": [{"txHash": hexHash(tx0.getHash()), "txIdx": 0, "satisfier": ["alice"]}],
+             "outputs": [{"amount": 50, "script": Script("ARG 0 SHA256 PUSH 0x00 EQUAL").serialize().hex()}],
+             "data": {"bytes": "00ff"}}]}
+        assert(rpc({"jsonrpc": "2.0", "id": 5, "method": "submitBlock", "params": [block]})["result"] == True)
+        assert(chain.getTip().getHash() == b.getHash())
+        spend = chain.getTip().getContents()[1]
+        assert(spend.data == b"\x00\xff")
+
+        found = rpc({"jsonrpc": "2.0", "id": 6, "method": "getTransaction", "params": [hexHash(spend.getHash())]})["result"]
+        assert(found["block"] == hexHash(b.getHash()) and found["transaction"]["data"] == {"bytes": "00ff"})
+        utxo = rpc({"jsonrpc": "2.0", "id": 7, "method": "getUnspentOutput", "params": [hexHash(spend.getHash()), 0]})["result"]
+        assert(utxo["amount"] == 50 and Script.deserialize(bytes.fromhex(utxo["script"])) == spend.outputs[0].constraint)
+        assert(rpc({"jsonrpc": "2.0", "id": 8, "method": "getUnspentOutput", "params": [hexHash(spend.getHash()), 1]})["result"] == None)
+        # the script output spent by b is no longer reported
+        assert(rpc({"jsonrpc": "2.0", "id": 11, "method": "getUnspentOutput", "params": [hexHash(tx0.getHash()), 0]})["result"] == None)
+        assert(rpc({"jsonrpc": "2.0", "id": 9, "method": "getBlock", "params": [hexHash(g.getHash())]})["result"]["transactions"][0]["outputs"][0]["script"] == alice.serialize().hex())
+        # unknown blocks are null, and asking doesn't add anything to the chain's index
+        known = len(chain.blockHashMapping)
+        assert(rpc({"jsonrpc": "2.0", "id": 12, "method": "getBlock", "params": [hexHash(1234)]})["result"] == None)
+        assert(rpc({"jsonrpc": "2.0", "id": 13, "method": "getCumulativeWork", "params": [hexHash(1234)]})["result"] == None)
+        assert(len(chain.blockHashMapping) == known)
+        assert(rpc({"jsonrpc": "2.0", "id": 10, "method": "submitBlock", "params": [{"parent": "zz"}]})["error"]["code"] == -32602)
+        # bad params are invalid params, a TypeError raised inside a handler is an internal error
+        for params in ([], [1, 2], {"hight": 0}, ["x"], [True], "0"):
+            assert(rpc({"jsonrpc": "2.0", "id": 14, "method": "getBlocksAtHeight", "params": params})["error"]["code"] == -32602)
+        assert(rpc({"jsonrpc": "2.0", "id": 15, "method": "submitBlock", "params": [{"parent": hexHash(g.getHash()), "nonce": 1,
+                    "transactions": [{"outputs": [{"amount": 1, "script": "00"}]}]}]})["error"]["code"] == -32602)
+        def broken(height):
+            return len(height)
+        server.methods["broken"] = broken
+        assert(rpc({"jsonrpc": "2.0", "id": 16, "method": "broken", "params": [1]})["error"]["code"] == -32603)
+
+        # the header cache keeps the most recently used headers only
+        server.maxHeaders = 2
+        for height in range(3):
+            rpc({"jsonrpc": "2.0", "id": 17, "method": "getBlocksAtHeight", "params": [height]})
+        assert(len(server.headerCache) == 2)
+    finally:
+        conn.close()
+        server.shutdown()
+
+def TestDuplicateBlocks():
+    chain = Blockchain(int("4" + ("F"*63),16), 50)
+    tgt = int("1" + ("F"*63),16)
+    g = chain.getTip()
+
+    # the same block twice: connected once, the tree doesn't grow
+    tx0 = Transaction(None, [Output(lambda x: True, 50)])
+    b1 = MineBlock(chain, g.getHash(), tgt, [ tx0 ])
+    assert(b1 != None)
+    assert(not chain.extend(b1))
+    assert(len(g.children) == 1 and len(chain.blockChain[g]) == 1)
+    assert(len(chain.getBlocksAtHeight(1)) == 1)
+    assert(chain.getDuplicateCounts()["known"] == 1)
+
+    # a block with a bad proof of work, then one built on it: neither is validated twice
+    bad = Block()
+    bad.setPriorBlockHash(b1.getHash())
+    bad.setContents(None)
+    bad.setTarget(1)
+    assert(not chain.extend(bad))
+    assert(not chain.extend(bad))
+    child = Block()
+    child.setPriorBlockHash(bad.getHash())
+    child.mine(tgt)
+    assert(not chain.extend(child))
+    assert(not chain.extend(child))
+    assert(chain.getRejectionCounts()["pow"] == 1)
+    assert(chain.getRejectionCounts()["orphan"] == 0)
+    assert(chain.getDuplicateCounts() == {"known": 1, "invalid": 2, "invalidParent": 1})
+
+    # bad contents are remembered with their merkle root: the same header with good contents is still accepted
+    spend = Transaction([Input(tx0.getHash(), 0, [])], [Output(lambda x: True, 51)])
+    b2 = Block()
+    b2.setPriorBlockHash(b1.getHash())
+    b2.setContents([ Transaction(None, [Output(lambda x: True, 50)]), spend ])
+    b2.mine(tgt)
+    assert(not chain.extend(b2))
+    assert(not chain.extend(b2))
+    assert(chain.getRejectionCounts()["amounts"] == 1)
+    b2.setContents([ Transaction(None, [Output(lambda x: True, 50)]) ])
+    assert(chain.extend(b2))
+    assert(chain.getTip() == b2)
+
+    # extendMany drops duplicates within the batch, and children of invalid blocks waiting as orphans
+    b3 = Block()
+    b3.setPriorBlockHash(b2.getHash())
+    b3.mine(tgt)
+    bad2 = Block()
+    bad2.setPriorBlockHash(b2.getHash())
+    bad2.time = 4
+    bad2.setTarget(1)
+    child2 = Block()
+    child2.setPriorBlockHash(bad2.getHash())
+    child2.mine(tgt)
+    assert(chain.extendMany([b1, child2, b3, b3, bad2]) == [False, False, True, False, False])
+    assert(len(b2.children) == 1 and chain.getTip() == b3)
+    assert(chain.getDuplicateCounts() == {"known": 3, "invalid": 3, "invalidParent": 2})
+    assert(chain.getRejectionCounts()["orphan"] == 0)
+
+    # the invalid block cache is bounded
+    chain.maxInvalidBlocks = 3
+    for i in range(5):
+        bad = Block()
+        bad.setPriorBlockHash(b3.getHash())
+        bad.nonce = i
+        bad.setTarget(1)
+        chain.extend(bad)
+    assert(len(chain.invalidBlocks) == 3)
+
+def TestHashMemo():
+    # a transaction is hashed from its current fields until it is put into a block
+    tx = Transaction(None, [Output(None, 5)])
+    h = tx.getHash()
+    tx.outputs.append(Output(None, 6))
+    assert(tx.getHash() != h and tx.frozenHash == None)
+    b = Block()
+    b.setContents([tx])
+    assert(tx.frozenHash != None and tx.getHash() == Transaction(None, [Output(None, 5), Output(None, 6)]).getHash())
+
+    # the merkle root is memoized per contents and reset by setContents
+    root = b.blockContents.calcMerkleRoot()
+    assert(root == HashableMerkleTree([tx]).calcMerkleRoot() and b.blockContents.merkleRoot == root)
+    b.setContents([tx, Transaction([Input(tx.getHash(), 0, [])], [Output(None, 5)])])
+    assert(b.blockContents.calcMerkleRoot() != root)
+
+    # block header changes, through the setters or not, give a new hash
+    h = b.getHash()
+    b.setPriorBlockHash(1)
+    h1 = b.getHash()
+    b.time = 4
+    h2 = b.getHash()
+    b.setTarget(5)
+    assert(len(set([h, h1, h2, b.getHash()])) == 4)
+    b.setPriorBlockHash(0)
+    b.time = 3
+    b.setTarget(8)
+    assert(b.getHash() == h and b.getHashBytes() == Hash32.fromInt(h))
+
+    # blocks are frozen when connected; the setters unfreeze them
+    chain = Blockchain(int("4" + ("F"*63),16), 50)
+    assert(chain.getTip().frozen)
+    b = MineBlock(chain, chain.getTip().getHash(), int("1" + ("F"*63),16), [ Transaction(None, [Output(None, 50)]) ])
+    assert(b.frozen and chain.blockHashMapping[b.getHash()] is b)
+    b.setPriorBlockHash(7)
+    assert(not b.frozen and b.getHash() not in chain.blockHashMapping)
+
+def TestHeadersOnly():
+    tgt = int("1" + ("F"*63),16)
+    full = Blockchain(int("4" + ("F"*63),16), 50)
+    light = Blockchain(int("4" + ("F"*63),16), 50, headersOnly=True)
+    assert(light.getTip().getHash() == full.getTip().getHash())
+    assert(type(light.getTip()) == BlockHeader)
+
+    # the same blocks, with a heavier fork: both chains pick the same tip
+    blocks = []
+    parent = full.getTip().getHash()
+    for i in range(4):
+        txs = [ Transaction(None, [Output(lambda x: True, 50 - i)]) ]
+        if i:
+            txs.append(Transaction([Input(blocks[-1].getContents()[0].getHash(), 0, [])], [Output(None, 1)]))
+        b = Block()
+        b.setPriorBlockHash(parent)
+        b.setContents(txs)
+        b.mine(tgt)
+        blocks.append(b)
+        parent = b.getHash()
+    fork = Block()
+    fork.setPriorBlockHash(blocks[1].getHash())
+    fork.mine(int(tgt/64))
+    for b in blocks + [fork]:
+        assert(full.extend(b))
+        assert(light.extend(b))
+    assert(light.getTip().getHash() == full.getTip().getHash() == fork.getHash())
+    assert(light.getCumulativeWork(fork.getHash()) == full.getCumulativeWork(fork.getHash()))
+    assert([b.getHash() for b in light.getBlocksAtHeight(4)] == [blocks[3].getHash()])
+
+    # only headers are kept, with no per instance dict
+    header = light.blockHashMapping[blocks[1].getHash()]
+    assert(type(header) == BlockHeader and header.getContents() == None)
+    assert(header.merkleRoot == blocks[1].getMerkleRoot() != 0)
+    assert(not hasattr(header, "__dict__"))
+
+    # headers can be fed directly, and are still checked for proof of work
+    bad = BlockHeader(parentBlockHash=fork.getHash(), target=1)
+    assert(not light.extend(bad))
+    h = BlockHeader(parentBlockHash=fork.getHash())
+    h.mine(tgt)
+    assert(light.extend(h) and light.getTip() is h)
+    assert(light.extendMany([blocks[3], h]) == [False, False])
+
+    # transaction inclusion from a proof, against the header's merkle root
+    full.extend(h)
+    spend = blocks[1].getContents()[1]
+    proof = blocks[1].getInclusionProof(1)
+    assert(light.verifyInclusion(spend.getHash(), blocks[1].getHash(), 1, proof))
+    assert(full.verifyInclusion(spend.getHash(), blocks[1].getHash(), 1, proof))
+    assert(not light.verifyInclusion(spend.getHash(), blocks[1].getHash(), 0, proof))
+    assert(not light.verifyInclusion(spend.getHash() ^ 1, blocks[1].getHash(), 1, proof))
+    # blocks[2] is no longer on the active chain
+    proof = blocks[2].getInclusionProof(0)
+    assert(verifyMerkleProof(blocks[2].getContents()[0].getHashBytes(), 0, proof, blocks[2].getMerkleRoot()))
+    assert(not light.verifyInclusion(blocks[2].getContents()[0].getHash(), blocks[2].getHash(), 0, proof))
+
+    # proofs for every position of odd and even sized trees
+    for n in range(1, 8):
+        txs = [ Transaction(None, [Output(None, i)]) for i in range(n) ]
+        tree = HashableMerkleTree(txs)
+        for i in range(n):
+            assert(verifyMerkleProof(txs[i].hashDigest(), i, tree.getProof(i), tree.calcMerkleRoot()))
+
+def TestChainStats():
+    chain = Blockchain(int("4" + ("F"*63),16), 50)
+    tgt = int("1" + ("F"*63),16)
+    assert(chain.getChainStats() == {"height": 0, "transactions": 0, "outputs": 0, "spent": 0, "minted": 0,
+                                     "burned": 0, "utxos": 0, "supply": 0})
+
+    tx0 = Transaction(None, [Output(lambda x: True, 50)])
+    b1 = MineBlock(chain, chain.getTip().getHash(), tgt, [ tx0 ])
+    burnMint = Transaction(None, [Output(lambda x: False, 0)])
+    tx1 = Transaction([Input(tx0.getHash(), 0, [])], [Output(lambda x: True, 30), Output(lambda x: True, 15)])
+    b2 = MineBlock(chain, b1.getHash(), tgt, [ burnMint, tx1 ])
+    assert(b2 != None)
+    assert(chain.getChainStats() == {"height": 2, "transactions": 3, "outputs": 4, "spent": 1, "minted": 50,
+                                     "burned": 5, "utxos": 3, "supply": 45})
+
+    # a heavier fork off b1 disconnects b2, and the totals follow
+    fork = Block()
+    fork.setPriorBlockHash(b1.getHash())
+    fork.setContents([ Transaction(None, [Output(lambda x: True, 20), Output(lambda x: True, 20)]) ])
+    fork.mine(int(tgt/64))
+    snap = chain.getSnapshot()
+    assert(chain.extend(fork) and chain.getTip() == fork)
+    assert(chain.getChainStats() == {"height": 2, "transactions": 2, "outputs": 3, "spent": 0, "minted": 90,
+                                     "burned": 0, "utxos": 3, "supply": 90})
+    # a snapshot taken before the reorg keeps its totals
+    assert(snap.getChainStats()["supply"] == 45)
+
+    # history per height, an empty block adds nothing
+    b3 = MineBlock(chain, fork.getHash(), tgt)
+    assert(list(chain.getSnapshot().getStatsHistory("supply")) == [0, 50, 90, 90])
+    assert(list(chain.getSnapshot().getStatsHistory("transactions")) == [0, 1, 2, 2])
+    assert(chain.getSnapshot().getStatsHistory("utxos").typecode == "q")
+
+    # the same totals as a full scan of the active chain
+    utxos = set()
+    supply = 0
+    for block, txn in chain.iterTransactions():
+        for input in txn.inputs:
+            utxos.discard((input.txHash, input.txIdx))
+        for i, output in enumerate(txn.outputs):
+            utxos.add((txn.getHash(), i))
+            supply += output.amount
+    assert(chain.getChainStats()["utxos"] == len(utxos) and chain.getChainStats()["supply"] == supply)
+
+    # an output spent once can't be spent again, in a later block or twice in one block, so the totals hold
+    spend = lambda amount: Transaction([Input(tx0.getHash(), 0, [])], [Output(lambda x: True, amount)])
+    b4 = MineBlock(chain, b3.getHash(), tgt, [ Transaction(None, [Output(lambda x: True, 1)]), spend(40) ])
+    assert(b4 != None)
+    assert(MineBlock(chain, b4.getHash(), tgt, [ Transaction(None, [Output(lambda x: True, 2)]), spend(39) ]) == None)
+    assert(MineBlock(chain, b3.getHash(), tgt, [ Transaction(None, [Output(lambda x: True, 3)]), spend(20), spend(19) ]) == None)
+    again = Block()
+    again.setPriorBlockHash(b4.getHash())
+    again.setContents([ Transaction(None, [Output(lambda x: True, 4)]), spend(38) ])
+    again.mine(tgt)
+    assert(chain.extendMany([again]) == [False])
+    assert(chain.getChainStats()["utxos"] == len(chain.getSnapshot().getUnspentOutputs()) == len(utxos) + 1)
+    assert(chain.getChainStats()["supply"] == supply + 1 - 10)
+
+    # totals past 64 bits: amounts are unbounded ints, the history falls back to a list
+    chain = Blockchain(int("4" + ("F"*63),16), 2**64)
+    snap = chain.getSnapshot()
+    b1 = MineBlock(chain, chain.getTip().getHash(), tgt, [ Transaction(None, [Output(None, 2**63)]) ])
+    assert(b1 != None and chain.getTip() == b1)
+    assert(chain.getChainStats()["minted"] == 2**63 and chain.getChainStats()["supply"] == 2**63)
+    assert(list(chain.getSnapshot().getStatsHistory("minted")) == [0, 2**63])
+    assert(chain.getSnapshot().getStatsHistory("outputs").typecode == "q")
+    assert(snap.getChainStats()["minted"] == 0)
+    b2 = MineBlock(chain, b1.getHash(), tgt, [ Transaction(None, [Output(None, 1)]) ])
+    assert(list(chain.getSnapshot().getStatsHistory("supply")) == [0, 2**63, 2**63 + 1])
+    assert(len(chain.activeChain) == 3)
+
+def TestUtxoCommitment():
+    # the set hash does not depend on order, and removing undoes adding
+    items = [MuHash.outputItem(i, 0, 10) for i in range(5)]
+    h1, h2 = MuHash(), MuHash()
+    for item in items:
+        h1.add(item)
+    for item in reversed(items):
+        h2.add(item)
+    assert(h1.digest() == h2.digest() and len(h1.digest()) == 32)
+    h2.add(MuHash.outputItem(7, 0, 10))
+    assert(h1.digest() != h2.digest())
+    h2.remove(MuHash.outputItem(7, 0, 10))
+    assert(h1.digest() == h2.digest())
+    assert(MuHash.mulMod(MuHash.PRIME - 1, MuHash.PRIME - 2) == (MuHash.PRIME - 1) * (MuHash.PRIME - 2) % MuHash.PRIME)
+
+    chain = Blockchain(int("4" + ("F"*63),16), 50)
+    tgt = int("1" + ("F"*63),16)
+    empty = chain.getUtxoCommitment()
+    assert(empty == MuHash().digest())
+
+    tx0 = Transaction(None, [Output(lambda x: True, 50)])
+    b1 = MineBlock(chain, chain.getTip().getHash(), tgt, [ tx0 ])
+    tx1 = Transaction([Input(tx0.getHash(), 0, [])], [Output(lambda x: True, 30), Output(lambda x: True, 15)])
+    b2 = MineBlock(chain, b1.getHash(), tgt, [ Transaction(None, [Output(lambda x: False, 0)]), tx1 ])
+    assert(b2 != None)
+
+    # the same as hashing the unspent outputs from scratch
+    def scan():
+        utxos = {}
+        for block, txn in chain.iterTransactions():
+            for input in txn.inputs:
+                del utxos[(input.txHash, input.txIdx)]
+            for i, output in enumerate(txn.outputs):
+                utxos[(txn.getHash(), i)] = output.amount
+        h = MuHash()
+        for (txHash, txIdx), amount in utxos.items():
+            h.add(MuHash.outputItem(txHash, txIdx, amount))
+        return h.digest()
+    atB2 = chain.getUtxoCommitment()
+    assert(atB2 == scan())
+    # the spent-aware lookup agrees: tx0's output is spent, tx1's are not
+    assert(chain.getUnspentOutput(tx0.getHash(), 0) == None and chain.getUnspentOutput(tx1.getHash(), 1).amount == 15)
+    atB2Snapshot = chain.getSnapshot()
+    assert((tx0.getHash(), 0) not in atB2Snapshot.getUnspentOutputs() and len(atB2Snapshot.getUnspentOutputs()) == 3)
+    assert(chain.getUtxoCommitment(0) == empty and chain.getUtxoCommitment(3) == None)
+
+    # a reorg away and back again restores the commitment at every height
+    fork = Block()
+    fork.setPriorBlockHash(b1.getHash())
+    fork.setContents([ Transaction(None, [Output(lambda x: True, 20)]) ])
+    fork.mine(int(tgt/4))
+    assert(chain.extend(fork) and chain.getTip() == fork)
+    assert(chain.getUtxoCommitment() == scan() != atB2)
+    assert(chain.getUnspentOutput(tx0.getHash(), 0).amount == 50 and chain.getUnspentOutput(tx1.getHash(), 1) == None)
+    # snapshots taken before the reorg keep their own view
+    assert((tx0.getHash(), 0) not in atB2Snapshot.getUnspentOutputs() and (tx1.getHash(), 1) in atB2Snapshot.getUnspentOutputs())
+    b3 = Block()
+    b3.setPriorBlockHash(b2.getHash())
+    b3.mine(int(tgt/8))
+    assert(chain.extend(b3) and chain.getTip() == b3)
+    assert(chain.getUtxoCommitment(2) == atB2 and chain.getUtxoCommitment() == atB2)
+    assert(chain.getUnspentOutput(tx0.getHash(), 0) == None and chain.getUnspentOutput(tx1.getHash(), 0).amount == 30)
+
+    # the lookup reads the snapshot, so it doesn't wait for a writer holding the lock
+    held, release = threading.Event(), threading.Event()
+    def holdLock():
+        with chain.writeLock:
+            held.set()
+            release.wait()
+    holder = threading.Thread(target=holdLock)
+    holder.start()
+    held.wait()
+    assert(chain.getUnspentOutput(tx1.getHash(), 1).amount == 15)
+    release.set()
+    holder.join()
+
+    # views share what didn't change, and fold the changes into a new base once they grow
+    view = UtxoView({(1, 0): 1, (2, 0): 2})
+    view2 = view.updated({(1, 0): None, (3, 0): 3})
+    assert(dict(view) == {(1, 0): 1, (2, 0): 2} and dict(view2) == {(2, 0): 2, (3, 0): 3} and len(view2) == 2)
+    assert(view2.base is view.base and (1, 0) not in view2 and view2.get((1, 0), "x") == "x")
+    big = view2.updated(dict(((i, 0), i) for i in range(4, 100)))
+    assert(big.changes == {} and len(big) == len(big.base) == 98 and view2.base is view.base)
+
+    # a second chain fed the same blocks in another order agrees
+    other = Blockchain(int("4" + ("F"*63),16), 50)
+    assert(all(other.extendMany([fork, b3, b2, b1])))
+    assert(other.getUtxoCommitment() == chain.getUtxoCommitment())
+
+def TestFinality():
+    tgt = int("1" + ("F"*63),16)
+    cache = ContentCache(MemoryContentStore())
+    chain = Blockchain(int("4" + ("F"*63),16), 50, contentCache=cache, finalityDepth=2)
+    g = chain.getTip()
+    times = iter(range(10, 100))
+
+    def mine(parent, txs=None, target=tgt):
+        b = Block()
+        b.time = next(times)
+        b.setPriorBlockHash(parent.getHash())
+        b.setContents(txs)
+        b.mine(target)
+        assert(chain.extend(b))
+        return b
+
+    # a fork two blocks deep off genesis, then the main chain overtakes it
+    s1 = mine(g, [ Transaction(None, [Output(lambda x: True, 50)]) ])
+    s2 = mine(s1)
+    a1 = mine(g)
+    a2 = mine(a1)
+    side = mine(a2)   # forks off height 2, which stays above finality for now
+    a3 = mine(a2, None, int(tgt/4))
+    assert(chain.getTip() == a3 and chain.getGcStats()["finalHeight"] == 1)
+
+    # the fork off genesis is gone from every index
+    for b in (s1, s2):
+        assert(b.getHash() not in chain.blockHashMapping and b not in chain.blockChain)
+    assert(g.children == [a1] and chain.blockChain[g] == [a1])
+    assert(s1.getHash() not in cache.store.blobs)
+    assert(chain.blockHashMapping[side.getHash()] is side)
+    stats = chain.getGcStats()
+    assert(stats["collectedBlocks"] == 2 and stats["collectedTransactions"] == 1 and stats["reclaimedBytes"] > 0)
+    # walking back from a collected block stops at the missing parent instead of inventing blank blocks
+    known = len(chain.blockHashMapping)
+    assert(list(chain.iterAncestors(s2)) == [])
+    try:
+        chain.findUnspentOutputs(s2)
+        assert(False)
+    except KeyError:
+        pass
+    assert(len(chain.blockHashMapping) == known and s1.getHash() not in chain.blockHashMapping)
+
+    # blocks forking off below finality are rejected before validation, resent collected blocks too
+    late = Block()
+    late.setPriorBlockHash(g.getHash())
+    late.setContents(None)
+    late.mine(int(tgt/1000))
+    assert(not chain.extend(late))
+    assert(not chain.extend(s1))
+    assert(chain.extendMany([late]) == [False])
+    assert(chain.getGcStats()["rejectedBelowFinality"] == 3)
+    assert(chain.getTip() == a3)
+
+    # the fork off height 2 goes once the tip is far enough ahead
+    a4 = mine(a3)
+    a5 = mine(a4)
+    assert(chain.getGcStats()["finalHeight"] == 3)
+    assert(side.getHash() not in chain.blockHashMapping and a2.children == [a3])
+    assert(chain.getGcStats()["collectedBlocks"] == 3)
+    # unspent output undo data is only kept for blocks that can still be disconnected
+    assert(set(chain.utxoUndo) == {a4.getHash(), a5.getHash()})
+    assert([b.getHash() for b in chain.iterAncestors(a5)][-1] == g.getHash())
+
 def Test():
     TestBlocks()
     TestMerkleTree()
     TestTransactionGraph()
     TestBlockchainOnly()
     TestBlockchainWithTransactions()
+    TestExtendMany()
+    TestStagedValidation()
+    TestBlockFilters()
+    TestConcurrentReaders()
+    TestAssumeValid()
+    TestLazyContents()
+    TestUtxoTable()
+    TestChainEvents()
+    TestChainIterators()
+    TestHash32()
+    TestScripts()
+    TestRpcServer()
+    TestDuplicateBlocks()
+    TestHashMemo()
+    TestHeadersOnly()
+    TestChainStats()
+    TestUtxoCommitment()
+    TestFinality()
 
 if __name__ == "__main__":
     Test()